@@ -19,12 +19,11 @@
 
 # %%
 import numpy as np
-import matplotlib.image as mpimg
-import matplotlib.pyplot as plt
 import cv2
 from collections import deque
 from collections import OrderedDict
 import pickle
+from functools import partial
 
 # %%
 from tools import camera_calibration
@@ -33,6 +32,15 @@ from tools import plotting
 from tools import lane_detect
 from tools import masking
 from tools import perspective_transform as pt
+from tools.geometry import CameraGeometry
+from tools.arena import FrameArena
+from tools.result import LaneResult
+from tools.pixels import PixelSet
+from tools.capture import DebugCapture
+from tools.timing import NULL_TIMER
+from tools.quality import FitQuality, QualityPolicy, measure_fit_quality
+from tools import fitting
+from tools import video
 
 
 # %% [markdown]
@@ -41,13 +49,33 @@ from tools import perspective_transform as pt
 # %%
 class LaneDetection:
     """Lane Detection."""
-    def __init__(self, mtx, dist, src, dst):
+    def __init__(self, mtx, dist, src, dst, img_size=None, geometry_cache=None, mask_roi=True, scale=1., 
+                 render_every=1, warp_overlay=False, capture=None, 
+                 timer=None, tracker=None, quality_policy=None):
         # Undistortion
         self.mtx = mtx
         self.dist = dist
         # Perspective transform
         self.src = src
         self.dst = dst
+        # Matrices and remap tables (for img_size=(width, height) or first frame size),
+        # loaded from geometry_cache folder if given
+        self.geometry_cache = geometry_cache
+        self.geometry = None
+        # Resolution of the bird's-eye image used for the lane search (relative to img),
+        # search window margin and pixel thresholds scale accordingly
+        self.scale = scale
+        self.margin = max(1, int(round(100 * scale)))
+        self.minpix = max(1, int(round(50 * scale**2)))
+        if img_size is not None:
+            self._init_geometry(img_size)
+        # Compute color masks only in region of interest (same result, less work)
+        self.mask_roi = mask_roi
+        # detect_lanes renders the annotated image for every render_every-th frame (0: never)
+        self.render_every = render_every
+        # Render the overlay in bird's-eye view and warp it back (slower, shows the lane pixels) 
+        # instead of drawing unwarped polygons
+        self.warp_overlay = warp_overlay
         
         # Curve fitted line
         self.left_fit = None
@@ -57,83 +85,322 @@ class LaneDetection:
         self.right_curve_diameter = deque(maxlen=3)
         
         self.frame_nb = 0
+        # Fits are only updated if they pass the quality policy, bad_frames counts rejected frames in a row
+        self.quality_policy = quality_policy if quality_policy is not None else QualityPolicy()
+        self.bad_frames = 0
+        self.reinit_frame_nb = 0
+        # Interim images of the last frame detected with save_interim_img
         self.imgs = OrderedDict()
+        # Interim images of sampled frames (none by default)
+        self.capture = capture if capture is not None else DebugCapture(every=0)
+        # Per-stage latency statistics (StageTimer, default: not measured)
+        self.timer = timer if timer is not None else NULL_TIMER
+        # Kalman filter over the fits (LaneTracker): smooths the fits and predicts them
+        # on frames which are not detected (default: every frame is detected, no filter)
+        self.tracker = tracker
+        # Reused per-frame arrays
+        self.arena = FrameArena()
 
-    def detect(self, img, save_interim_img=False, debug_mode=False):
-        """Lane detection function."""
-        if debug_mode:
-            save_interim_img = True
-        # Distortion correction
-        img_undist = camera_calibration.undistort_image(img, self.mtx, self.dist)
-        img_bright_binary = masking.get_yellow_white_and_bright_pixel_mask(img_undist)
+    def _init_geometry(self, img_size):
+        """Load or build perspective matrices and remap tables for img_size 
+        (shared with other LaneDetection instances in this process using the same camera)."""
+        self.geometry = CameraGeometry.shared(self.mtx, self.dist, self.src, self.dst, img_size, self.scale, 
+                                              cache_dir=self.geometry_cache)
+
+    def _check_geometry(self, img_size):
+        if self.geometry is None or img_size != self.geometry.size:
+            self._init_geometry(img_size)
+
+    def _mask_and_warp(self, img, arena):
+        """Binary lane pixel mask of img (one image or a stack of images) in bird's-eye view."""
+        roi_slices = (Ellipsis,) + self.geometry.roi_slices + (slice(None),)
+        img_mask_input = img[roi_slices] if self.mask_roi else img
+        mask_shape = img_mask_input.shape[:-1]
+        with self.timer.stage('mask'):
+            img_bright_binary = masking.get_yellow_white_and_bright_pixel_mask(img_mask_input, 
+                out=arena.get('img_bright_binary', mask_shape), buffer=arena.get('img_bgra', mask_shape + (4,)), 
+                index=arena.get('img_lut_index', mask_shape, np.intp))
+        if not self.mask_roi:
+            img_bright_binary = img_bright_binary[roi_slices[:-1]]
         
-        # 4. Perspective transform
-        M, Minv = pt.get_perspective_transform_matrices(img_bright_binary, self.src, self.dst)
-        img_binary_warped = pt.warp_img(img_bright_binary, M_or_Minv=M)
+        # 4. Distortion correction and perspective transform (one remap per image)
+        warped_shape = mask_shape[:-2] + (self.geometry.warp_size[1], self.geometry.warp_size[0])
+        img_binary_warped = arena.get('img_binary_warped', warped_shape)
+        with self.timer.stage('warp'):
+            if img.ndim == 3:
+                pt.remap_img(img_bright_binary, self.geometry.warp_maps, out=img_binary_warped)
+            else:
+                for i in range(img.shape[0]):
+                    pt.remap_img(img_bright_binary[i], self.geometry.warp_maps, out=img_binary_warped[i])
+        return img_binary_warped
+
+    def _find_lanes(self, img_binary_warped, capture=None):
+        """Search lane pixels around the previous fits and update the fits if they pass the quality policy,
+        otherwise the last good fits are kept. The sliding window search runs on the first frame and when 
+        the quality stays bad (see QualityPolicy). Fitting is skipped if there are too few pixels.
+        Fits are stored in full resolution, search runs in warped resolution. Returns lanes_xy 
+        (None if no lane was found yet), lanes_pixels and the FitQuality.
+        Interim images are only drawn if capture (DebugCapture) keeps them."""
+        policy = self.quality_policy
+        # - Sliding windows (first frame and re-initialization)
+        seeds = None
+        pixels = None
+        if self.left_fit is None or policy.reinit_due(self.bad_frames, self.frame_nb - self.reinit_frame_nb):
+            self.reinit_frame_nb = self.frame_nb
+            # Nonzero pixels of the whole image, shared by both searches
+            with self.timer.stage('pixels'):
+                pixels = PixelSet.from_image(img_binary_warped)
+            with self.timer.stage('initial_search'):
+                leftx, lefty, rightx, righty, _, _ = lane_detect.find_lane_pixels_in_boxes(
+                    img_binary_warped, margin=self.margin, minpix=self.minpix, pixels=pixels)
+                if policy.enough_pixels(len(leftx), len(rightx), self.scale):
+                    seeds = fitting.fit_poly2((lefty, righty), (leftx, rightx))
+            if capture is not None and seeds is not None:
+                capture.add('img_histogram', lambda: pixels.histogram(img_binary_warped.shape[0]//2))
+                capture.add('img_rectangle_warped', lambda: lane_detect.detect_initial_lane_line(
+                    img_binary_warped, True, margin=self.margin, minpix=self.minpix, pixels=pixels)[2])
+        if seeds is None and self.left_fit is not None:
+            seeds = (lane_detect.scale_fit(self.left_fit, self.scale), lane_detect.scale_fit(self.right_fit, self.scale))
         
-        # 5. Detect lane line
-        # - Init run (only once)
+        # - Search around the seeds (on tracking frames only the corridors are read)
+        if seeds is None:
+            no_pixels = np.empty(0, np.int32), np.empty(0, np.int32)
+            lanes_pixels = (no_pixels, no_pixels)
+        else:
+            with self.timer.stage('lane_search'):
+                lanes_pixels = lane_detect.find_lane_pixels_around_fits(img_binary_warped, seeds, self.margin, 
+                                                                        pixels, self.arena)
+        (leftx, lefty), (rightx, righty) = lanes_pixels
+        quality = FitQuality(len(leftx), len(rightx))
+        if policy.enough_pixels(len(leftx), len(rightx), self.scale):
+            with self.timer.stage('fit'):
+                fits = fitting.fit_poly2((lefty, righty), (leftx, rightx))
+                quality = measure_fit_quality(fits[0], fits[1], lanes_pixels[0], lanes_pixels[1], 
+                                              img_binary_warped.shape, self.scale)
+            if capture is not None:
+                capture.add('img_lane_warped', lambda: lane_detect.detect_further_lane_line(
+                    img_binary_warped, seeds[0], seeds[1], True, margin=self.margin, pixels=pixels)[4])
+        if policy.check(quality, self.scale):
+            self.left_fit = lane_detect.scale_fit(fits[0], 1. / self.scale)
+            self.right_fit = lane_detect.scale_fit(fits[1], 1. / self.scale)
+            self.bad_frames = 0
+        else:
+            self.bad_frames += 1
+        lanes_xy = None if self.left_fit is None else self._get_lanes_xy()
+        return lanes_xy, lanes_pixels, quality
+
+    def detect_lanes(self, img, render=None, save_interim_img=False, out=None):
+        """Lane detection returning a LaneResult (fits, curvatures, distance to center, pixel counts).
+        The annotated image (result.img, written to out if given) is rendered if render is True, 
+        or for every render_every-th frame if render is None (never if render_every is 0).
+        Interim images are captured by self.capture, or all of them to self.imgs if save_interim_img."""
+        with self.timer.frame():
+            return self._detect_lanes(img, render, save_interim_img, out)
+
+    def _detect_lanes(self, img, render, save_interim_img, out):
+        capture = DebugCapture(max_bytes=None) if save_interim_img else self.capture
+        capture.begin(self.frame_nb)
+        img_size = (img.shape[1], img.shape[0])
+        self._check_geometry(img_size)
+        quality = None
+        detected = self._predict()
+        if detected:
+            img_binary_warped = self._mask_and_warp(img, self.arena)
+            capture.add('img_binary_warped', img_binary_warped)
+            
+            # 5. Detect lane line (the search starts at the predicted fits)
+            lanes_xy, lanes_pixels, quality = self._find_lanes(img_binary_warped, capture)
+            if self._update_tracker(quality, img_size[1]):
+                lanes_xy = self._get_lanes_xy()
+        else:
+            # Predicted frame: no masking, warping and search
+            img_binary_warped = self.arena.get('img_binary_warped', 
+                (self.geometry.warp_size[1], self.geometry.warp_size[0]))
+            img_binary_warped.fill(0)
+            lanes_xy = self._get_lanes_xy()
+            no_pixels = np.empty(0, np.int64)
+            lanes_pixels = ((no_pixels, no_pixels), (no_pixels, no_pixels))
         if self.left_fit is None:
-            self.left_fit, self.right_fit, img_rectangle_warped, img_histogram = lane_detect.detect_initial_lane_line(img_binary_warped, save_interim_img)
-            if save_interim_img:
-                self.imgs['img_histogram'] = img_histogram
-                self.imgs['img_rectangle_warped'] = img_rectangle_warped
-        # - Further runs
-        fits, lanes_xy, lanes_inds, lines_pts, img_lane_warped = lane_detect.detect_further_lane_line(
-            img_binary_warped, self.left_fit, self.right_fit, save_interim_img)
-        if save_interim_img:
-                self.imgs['img_lane_warped'] = img_lane_warped
-        left_fitx, right_fitx, ploty = lanes_xy
-        left_fit, right_fit = fits
-        left_lane_inds, right_lane_inds = lanes_inds
-        left_line_pts, right_line_pts = lines_pts
-        #left_points_count, right_points_count = pts_counts
-        
-        # Determine lane curvature
-        left_curve, right_curve = calc.measure_curvature_real(ploty, left_fitx, right_fitx)
-        self.left_curve_diameter.append(left_curve)
-        self.right_curve_diameter.append(right_curve)
+            # No lane found yet
+            left_fit = right_fit = np.full(3, np.nan)
+            left_curve = right_curve = dist_to_center = np.nan
+        else:
+            left_fit, right_fit = self.left_fit, self.right_fit
+            # Determine lane curvature (from the full resolution fits)
+            with self.timer.stage('curvature'):
+                left_curve, right_curve = calc.measure_curvature_real_from_fits(left_fit, right_fit, img_size[1])
+                dist_to_center = calc.calc_dist_to_center_from_fits(img_size[0], img_size[1], left_fit, right_fit)
+            self.left_curve_diameter.append(left_curve)
+            self.right_curve_diameter.append(right_curve)
         
-        # Add colored lanes and plane
-        _, img_colored_lanes_warp = plotting.add_colored_lanes(img_binary_warped, left_lane_inds, right_lane_inds)
-        img_colored_plane_warp = plotting.add_colored_plane(img_binary_warped, left_fitx, right_fitx, ploty)
-        img_colored_warp = plotting.combine_images(img_colored_lanes_warp, img_colored_plane_warp)
-        # Warp back
-        img_colored_unwarp = pt.warp_img(img_colored_warp, Minv)
-        img_unwarp = plotting.combine_images(img_undist, img_colored_unwarp, val1=1., val2=1.)
+        result = LaneResult(self.frame_nb, left_fit, right_fit, left_curve, right_curve, dist_to_center, 
+                            len(lanes_pixels[0][0]), len(lanes_pixels[1][0]), detected=detected, quality=quality)
+        if render is None:
+            # Sampled frames with rejected fits are not rendered
+            render = (self.render_every > 0 and self.frame_nb % self.render_every == 0 
+                      and (quality is None or quality.ok))
+        if render:
+            with self.timer.stage('render'):
+                result.img = self._render(img, img_binary_warped, lanes_xy, lanes_pixels, dist_to_center, 
+                                          self.arena, capture, out)
+        with self.timer.stage('capture'):
+            imgs = capture.end(result)
         if save_interim_img:
-            self.imgs['img_colored_lanes_warp'] = img_colored_lanes_warp
-            self.imgs['img_colored_plane_warp'] = img_colored_plane_warp
-            self.imgs['img_colored_warp'] = img_colored_warp
-            self.imgs['img_colored_unwarp'] = img_colored_unwarp
-            self.imgs['img_unwarp'] = img_unwarp
+            # Only the images of this frame (stages which did not run on it are missing)
+            self.imgs = imgs
+        self.frame_nb += 1
+        return result
+
+    def _predict(self):
+        """Advance the tracker (if any) to the current frame, returns True if the frame has to be detected."""
+        tracker = self.tracker
+        if tracker is None or not tracker.initialized:
+            return True
+        with self.timer.stage('predict'):
+            self.left_fit, self.right_fit = tracker.predict()
+        return tracker.needs_detection()
+
+    def _update_tracker(self, quality, img_height):
+        """Correct the tracker (if any) with the accepted fits, returns True if the fits were filtered."""
+        if self.tracker is None or not quality.ok:
+            return False
+        self.left_fit, self.right_fit = self.tracker.update(self.left_fit, self.right_fit, img_height)
+        return True
+
+    def _get_lanes_xy(self):
+        """x values of the current fits at every row of the (scaled) bird's-eye image."""
+        return lane_detect.get_x_and_y_of_fits(self.geometry.warp_size[1], 
+            lane_detect.scale_fit(self.left_fit, self.scale), lane_detect.scale_fit(self.right_fit, self.scale))
+
+    def _render(self, img, img_binary_warped, lanes_xy, lanes_pixels, dist_to_center, arena, 
+                capture=None, out=None):
+        """Draw lanes, plane and values onto the undistorted img."""
+        img_size = (img.shape[1], img.shape[0])
+        if lanes_xy is None:
+            # Nothing to draw
+            img_unwarp = camera_calibration.undistort_image_with_maps(img, self.geometry.undistort_maps, out=out)
+        elif self.warp_overlay:
+            left_fitx, right_fitx, ploty = lanes_xy
+            left_pixels, right_pixels = lanes_pixels
+            # Add colored lanes and plane
+            color_shape = img_binary_warped.shape + (3,)
+            _, img_colored_lanes_warp = plotting.add_colored_lanes(img_binary_warped, left_pixels, right_pixels,
+                out=(arena.get('img_lanes_warp', color_shape), arena.get('img_colored_lanes_warp', color_shape)))
+            img_colored_plane_warp = plotting.add_colored_plane(img_binary_warped, left_fitx, right_fitx, ploty, 
+                out=arena.get('img_colored_plane_warp', color_shape))
+            img_colored_warp = plotting.combine_images(img_colored_lanes_warp, img_colored_plane_warp, 
+                out=arena.get('img_colored_warp', color_shape))
+            # Warp back
+            img_colored_unwarp = pt.warp_img(img_colored_warp, self.geometry.Minv_warp, 
+                out=arena.get('img_colored_unwarp', img.shape), dsize=img_size)
+            # Distortion correction (only needed for the overlay)
+            img_undist = camera_calibration.undistort_image_with_maps(img, self.geometry.undistort_maps, 
+                out=arena.get('img_undist', img.shape))
+            img_unwarp = plotting.combine_images(img_undist, img_colored_unwarp, val1=1., val2=1., out=out)
+            if capture is not None:
+                capture.add('img_colored_lanes_warp', img_colored_lanes_warp)
+                capture.add('img_colored_plane_warp', img_colored_plane_warp)
+                capture.add('img_colored_warp', img_colored_warp)
+                capture.add('img_colored_unwarp', img_colored_unwarp)
+        else:
+            # Only the overlay polygon vertices are unwarped, the overlay is added in place
+            left_fitx, right_fitx, ploty = lanes_xy
+            with self.timer.stage('undistort'):
+                img_unwarp = camera_calibration.undistort_image_with_maps(img, self.geometry.undistort_maps, out=out)
+            with self.timer.stage('overlay'):
+                plotting.add_lane_overlay(img_unwarp, left_fitx, right_fitx, ploty, self.geometry.Minv_warp, 
+                    lane_half_width=max(1, 10 * self.scale), buffer=arena.get('img_overlay', img.shape))
+        if capture is not None:
+            capture.add('img_unwarp', img_unwarp)
         # Add infos
-        dist_to_center = calc.calc_dist_to_center(img_unwarp.shape[1], left_fitx, right_fitx)
-        img_result = plotting.add_text_values(img_unwarp, np.mean(self.left_curve_diameter), 
-            np.mean(self.right_curve_diameter), dist_to_center)
+        with self.timer.stage('text'):
+            return plotting.add_text_values(img_unwarp, np.mean(self.left_curve_diameter), 
+                np.mean(self.right_curve_diameter), dist_to_center)
 
-        self.frame_nb += 1
+    def detect(self, img, save_interim_img=False, debug_mode=False, out=None):
+        """Lane detection function, returns the annotated image (see detect_lanes for results without image). 
+        The result is written to out (same shape as img) if given, otherwise to a new image."""
+        if debug_mode:
+            save_interim_img = True
+        result = self.detect_lanes(img, render=True, save_interim_img=save_interim_img, out=out)
         if debug_mode:
+            # Bird's-eye search image, the annotated image if there was no fit on this frame
+            # (predicted frame or too few pixels)
+            if 'img_lane_warped' in self.imgs:
+                img_lane_warped = self.imgs['img_lane_warped']
+            else:
+                img_lane_warped = result.img
             font = cv2.FONT_HERSHEY_SIMPLEX
             color_white = (255, 255, 255)
-            cv2.putText(img_lane_warped, '{:.3}, {:.3}, {:.3}'.format(*left_fit), (50, 200), font, 1.2, color_white, thickness=2)
-            cv2.putText(img_lane_warped, '{:.3}, {:.3}, {:.3}'.format(*right_fit), (50, 250), font, 1.2, color_white, thickness=2)
+            cv2.putText(img_lane_warped, '{:.3}, {:.3}, {:.3}'.format(*result.left_fit), (50, 200), font, 1.2, color_white, thickness=2)
+            cv2.putText(img_lane_warped, '{:.3}, {:.3}, {:.3}'.format(*result.right_fit), (50, 250), font, 1.2, color_white, thickness=2)
             cv2.putText(img_lane_warped, "frame:{}".format(self.frame_nb), (50, 50), font, 1.2, color_white, thickness=2)
             #cv2.putText(img_lane_warped, "left_points:{}".format(left_points_count), (400, 50), font, 1.2, fontColor, thickness=2)
             #cv2.putText(img_lane_warped, "right_points:{}".format(right_points_count), (400, 100), font, 1.2, fontColor, thickness=2)
             return img_lane_warped
         else:
-            return img_result
+            return result.img
+
+    def detect_batch(self, frames, batch_size=8):
+        """Lane detection (without rendering) for a stack of consecutive frames (N, height, width, 3). 
+        Masking and warping run on sub-stacks of batch_size frames, the lane search of each frame tracks 
+        the fits of the previous frame. With a tracker, fits are predicted and updated as in detect_lanes 
+        (predicted frames are masked and warped too, but not searched). The sub-stack buffers are freed 
+        at the end, the buffers of detect_lanes are not touched.
+        Returns fits (N, 2, 3), curvatures (N, 2) and distances to center (N,)."""
+        nb_frames, height, width = frames.shape[:3]
+        self._check_geometry((width, height))
+        batch_arena = FrameArena()
+        
+        fits = np.empty((nb_frames, 2, 3))
+        for start in range(0, nb_frames, batch_size):
+            imgs_binary_warped = self._mask_and_warp(frames[start:start + batch_size], batch_arena)
+            for i, img_binary_warped in enumerate(imgs_binary_warped, start):
+                if self._predict():
+                    _, _, quality = self._find_lanes(img_binary_warped)
+                    self._update_tracker(quality, height)
+                fits[i] = (self.left_fit, self.right_fit) if self.left_fit is not None else np.nan
+                self.frame_nb += 1
+        
+        # Curvature and distance to center of all frames at once
+        curvatures = np.column_stack(calc.measure_curvature_real_from_fits(fits[:, 0], fits[:, 1], height))
+        dists_to_center = calc.calc_dist_to_center_from_fits(width, height, fits[:, 0], fits[:, 1])
+        # Frames before the first fit have no curvature (skipped like in detect_lanes)
+        found = np.isfinite(curvatures).all(axis=1)
+        self.left_curve_diameter.extend(curvatures[found, 0])
+        self.right_curve_diameter.extend(curvatures[found, 1])
+        return fits, curvatures, dists_to_center
         
+    def process_video(self, input_path, output_path, **kwargs):
+        """Detect lanes in all frames of a video file (see tools/video.py). Returns throughput statistics."""
+        return video.process_video(self, input_path, output_path, **kwargs)
+
+    def process_video_parallel(self, input_path, output_path, **kwargs):
+        """Detect lanes in a video file with a pool of processes, each using a new LaneDetection 
+        with the settings of this one (see tools/video.py). Returns throughput statistics."""
+        return video.process_video_parallel(self._factory(), input_path, output_path, **kwargs)
+
+    def _factory(self):
+        """Picklable callable which creates a new LaneDetection with the same settings."""
+        return partial(type(self), self.mtx, self.dist, self.src, self.dst, geometry_cache=self.geometry_cache, 
+                       mask_roi=self.mask_roi, scale=self.scale, render_every=self.render_every, 
+                       warp_overlay=self.warp_overlay, tracker=self.tracker.new() if self.tracker else None, 
+                       quality_policy=self.quality_policy)
+
     def reset(self):
         self.left_fit = None
         self.right_fit = None
         self.left_curve_diameter = deque(maxlen=3)
         self.right_curve_diameter = deque(maxlen=3)
         self.frame_nb = 0
+        self.bad_frames = 0
+        self.reinit_frame_nb = 0
+        if self.tracker is not None:
+            self.tracker.reset()
 
 # %%
 ## Read fct, calibration values and perspective transformation parameters
+#import matplotlib.pyplot as plt
 #def cv2_imread(path):
 #    return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
 #calib = pickle.load(open("tools/calibration.p", "rb" ))
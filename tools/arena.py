@@ -0,0 +1,49 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Arena
+#
+# Preallocated arrays which are reused frame after frame, so the detection
+# pipeline does not allocate full-frame arrays in steady state.
+
+# %%
+import numpy as np
+
+# %%
+class FrameArena():
+    """Named, reusable arrays. An array is (re)allocated only if shape or dtype changes.
+
+    >>> arena = FrameArena()
+    >>> img_binary = arena.get("img_binary", (720, 1280))
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=np.uint8):
+        """Get array called name with shape and dtype (content is undefined)."""
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = np.empty(shape, dtype)
+            self.buffers[name] = buf
+        return buf
+
+    @property
+    def nbytes(self):
+        """Memory used by all arrays."""
+        return sum(buf.nbytes for buf in self.buffers.values())
+
+    def clear(self):
+        self.buffers = {}
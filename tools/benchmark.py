@@ -0,0 +1,224 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Benchmark
+#
+# Benchmarks of the pipeline stages and of the full detection on synthetic road
+# frames (no downloads needed) at several resolutions. Results (median time,
+# throughput and peak memory of one call) can be saved as JSON baseline and
+# compared against it:
+#
+#     python -m tools.benchmark --save benchmark_baseline.json
+#     python -m tools.benchmark --compare benchmark_baseline.json --threshold 0.2
+#
+# The comparison exits with status 1 if a benchmark got slower or needs more
+# memory than the baseline by more than the threshold.
+
+# %%
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+import cv2
+
+from tools import masking
+from tools import perspective_transform as pt
+from tools import lane_detect
+from tools import calc
+from tools import fitting
+from tools import plotting
+
+# %%
+RESOLUTIONS = ((640, 360), (1280, 720), (1920, 1080))
+
+# Perspective transform points for 1280x720 (scaled to other resolutions)
+SRC = np.float32([(526, 496), (762, 496), (1016, 664), (288, 664)])
+DST = np.float32([(288, 464), (996, 464), (976, 664), (288, 664)])
+
+
+def get_camera(img_size):
+    """Camera matrix, distortion coefficients, src and dst of a synthetic camera for img_size."""
+    width, height = img_size
+    s = np.float32([width / 1280., height / 720.])
+    mtx = np.array([[width, 0., width / 2.], [0., width, height / 2.], [0., 0., 1.]])
+    dist = np.zeros((1, 5))
+    return mtx, dist, SRC * s, DST * s
+
+
+def make_road_frame(img_size, frame_nb=0, seed=0):
+    """Synthetic RGB camera frame of a road with a yellow left lane and a dashed white right lane.
+    The road curves slowly over frame_nb."""
+    width, height = img_size
+    rng = np.random.RandomState(seed + frame_nb)
+    s = width / 1280.
+    # Road in bird's-eye view: noisy asphalt with two lane lines
+    bev = rng.randint(90, 115, (height, width, 3)).astype(np.uint8)
+    ys = np.arange(0, height + 1, 4, dtype=np.float64)
+    curve = 40 * s * np.sin(frame_nb / 20.) * ((height - ys) / height)**2
+    for x0, color, dashed in ((300, (230, 200, 40), False), (980, (250, 250, 250), True)):
+        xs = x0 * s + curve
+        for start in range(0, len(ys) - 1, 10 if dashed else len(ys) - 1):
+            if dashed and (start // 10 + frame_nb) % 3 == 0:
+                continue
+            end = min(start + 10 if dashed else len(ys) - 1, len(ys) - 1)
+            left = np.column_stack((xs[start:end+1] - 8 * s, ys[start:end+1]))
+            right = np.column_stack((xs[start:end+1] + 8 * s, ys[start:end+1]))[::-1]
+            cv2.fillPoly(bev, [np.int32(np.vstack((left, right)))], color)
+    # Camera view, sky above the road
+    _, _, src, dst = get_camera(img_size)
+    Minv = cv2.getPerspectiveTransform(dst, src)
+    frame = cv2.warpPerspective(bev, Minv, img_size, borderMode=cv2.BORDER_CONSTANT, borderValue=(120, 160, 200))
+    return frame
+
+
+# %%
+def measure(fct, min_time=0.2, max_repeat=200):
+    """Median time [s] of fct() (after one warm-up call) and peak memory [bytes] traced during one call."""
+    fct()
+    tracemalloc.start()
+    fct()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times = []
+    t_end = time.perf_counter() + min_time
+    while len(times) < max_repeat and (len(times) < 3 or time.perf_counter() < t_end):
+        t = time.perf_counter()
+        fct()
+        times.append(time.perf_counter() - t)
+    return float(np.median(times)), peak
+
+
+def _cycle(frames):
+    """Function returning the frames one after another."""
+    state = {"i": -1}
+
+    def next_frame():
+        state["i"] = (state["i"] + 1) % len(frames)
+        return frames[state["i"]]
+    return next_frame
+
+
+def get_benchmarks(img_size, nb_frames=8):
+    """Dict name -> function to benchmark for frames of img_size."""
+    from LaneDetection import LaneDetection
+
+    mtx, dist, src, dst = get_camera(img_size)
+    frames = [make_road_frame(img_size, i) for i in range(nb_frames)]
+    next_frame = _cycle(frames)
+    M, Minv = pt.get_perspective_transform_matrices(frames[0], src, dst)
+    img_binary = masking.get_yellow_white_and_bright_pixel_mask(frames[0])
+    img_binary_warped = pt.warp_img(img_binary, M)
+    left_fit, right_fit, _, _ = lane_detect.detect_initial_lane_line(img_binary_warped)
+    fits, lanes_xy, lanes_pixels, _, _ = lane_detect.detect_further_lane_line(img_binary_warped, left_fit, right_fit)
+    left_fitx, right_fitx, ploty = lanes_xy
+    img_colored_warp = plotting.add_colored_plane(img_binary_warped, left_fitx, right_fitx, ploty)
+    ld = LaneDetection(mtx, dist, src, dst)
+    ld_headless = LaneDetection(mtx, dist, src, dst, render_every=0)
+    out = np.empty_like(frames[0])
+
+    return {
+        "mask": lambda: masking.get_yellow_white_and_bright_pixel_mask(next_frame()),
+        "warp_img": lambda: pt.warp_img(next_frame(), M),
+        "find_lane_pixels_in_boxes": lambda: lane_detect.find_lane_pixels_in_boxes(img_binary_warped),
+        "detect_further_lane_line": lambda: lane_detect.detect_further_lane_line(
+            img_binary_warped, left_fit, right_fit),
+        "fit_poly2": lambda: fitting.fit_poly2((lanes_pixels[0][1], lanes_pixels[1][1]),
+                                               (lanes_pixels[0][0], lanes_pixels[1][0])),
+        "measure_curvature_real": lambda: calc.measure_curvature_real(ploty, left_fitx, right_fitx),
+        "measure_curvature_real_from_fits": lambda: calc.measure_curvature_real_from_fits(
+            fits[0], fits[1], img_size[1]),
+        "add_colored_lanes": lambda: plotting.add_colored_lanes(img_binary_warped, *lanes_pixels),
+        "add_colored_plane": lambda: plotting.add_colored_plane(img_binary_warped, left_fitx, right_fitx, ploty),
+        "add_lane_overlay": lambda: plotting.add_lane_overlay(next_frame().copy(), left_fitx, right_fitx,
+                                                              ploty, Minv),
+        "combine_images": lambda: plotting.combine_images(next_frame(), img_colored_warp, val1=1., val2=1.),
+        "add_text_values": lambda: plotting.add_text_values(next_frame().copy(), 1000., 1200., 0.1),
+        "detect": lambda: ld.detect(next_frame(), out=out),
+        "detect_lanes_headless": lambda: ld_headless.detect_lanes(next_frame()),
+    }
+
+
+def run(resolutions=RESOLUTIONS, select=None, min_time=0.2, verbose=True):
+    """Run all benchmarks (or those whose name contains one of select) for all resolutions.
+    Returns dict with meta data and results {"<width>x<height>/<name>": {"ms", "fps", "peak_bytes"}}."""
+    results = {}
+    for img_size in resolutions:
+        for name, fct in get_benchmarks(tuple(img_size)).items():
+            if select and not any(s in name for s in select):
+                continue
+            seconds, peak = measure(fct, min_time)
+            key = "{}x{}/{}".format(img_size[0], img_size[1], name)
+            results[key] = {"ms": seconds * 1e3, "fps": 1. / seconds, "peak_bytes": peak}
+            if verbose:
+                print("{:<45}{:>10.3f} ms{:>10.1f} /s{:>10.2f} MB".format(key, seconds * 1e3, 1. / seconds, peak / 1e6))
+    meta = {"python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__,
+            "machine": platform.machine(), "processor": platform.processor(), "cpu_threads": cv2.getNumThreads()}
+    return {"meta": meta, "results": results}
+
+
+def compare(current, baseline, threshold=0.2, min_peak_bytes=64 * 1024):
+    """Regressions of current vs. baseline (dicts returned by run): benchmarks slower by more than
+    threshold (relative), or with a peak memory larger by more than threshold and min_peak_bytes.
+    Returns list of messages (empty if there are none)."""
+    regressions = []
+    for key, result in current["results"].items():
+        base = baseline["results"].get(key)
+        if base is None:
+            continue
+        if result["ms"] > base["ms"] * (1 + threshold):
+            regressions.append("{}: {:.3f} ms (baseline {:.3f} ms, {:+.0%})".format(
+                key, result["ms"], base["ms"], result["ms"] / base["ms"] - 1))
+        extra_bytes = result["peak_bytes"] - base["peak_bytes"]
+        if extra_bytes > max(base["peak_bytes"] * threshold, min_peak_bytes):
+            regressions.append("{}: peak memory {:.2f} MB (baseline {:.2f} MB)".format(
+                key, result["peak_bytes"] / 1e6, base["peak_bytes"] / 1e6))
+    return regressions
+
+
+# %%
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the lane detection on synthetic frames.")
+    parser.add_argument("--save", help="save results as JSON baseline to this file")
+    parser.add_argument("--compare", help="compare results with this JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative regression (default 0.2)")
+    parser.add_argument("--resolutions", nargs="+", default=["{}x{}".format(*r) for r in RESOLUTIONS],
+                        help="e.g. 640x360 1280x720")
+    parser.add_argument("--select", nargs="+", help="only benchmarks containing one of these names")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum time per benchmark in s")
+    args = parser.parse_args(argv)
+
+    resolutions = [tuple(int(v) for v in r.split("x")) for r in args.resolutions]
+    current = run(resolutions, args.select, args.min_time)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print("Regressions (threshold {:.0%}):".format(args.threshold))
+            print("\n".join(regressions))
+            return 1
+        print("No regressions (threshold {:.0%}).".format(args.threshold))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -19,12 +19,15 @@
 # %%
 import numpy as np
 
+from tools import fitting
+
 # %%
 def calc_dist_to_center(img_width, left_fitx, right_fitx):
-    """Calculate the distance to the center of the street."""
+    """Calculate the distance to the center of the street.
+    left_fitx and right_fitx can be stacked (one row per frame)."""
     center = img_width / 2.
-    left_bottom_x = left_fitx[-1]
-    right_bottom_x = right_fitx[-1]
+    left_bottom_x = left_fitx[..., -1]
+    right_bottom_x = right_fitx[..., -1]
 
     lane_width = right_bottom_x - left_bottom_x
     center_lane = (lane_width / 2.0) + left_bottom_x
@@ -34,16 +37,63 @@ def calc_dist_to_center(img_width, left_fitx, right_fitx):
 
 # %%
 def measure_curvature_real(ploty, left_fitx, right_fitx):
-    """Calculates the curvature of polynomial functions in meters."""
+    """Calculates the curvature of polynomial functions in meters.
+    left_fitx and right_fitx can be stacked (one row per frame)."""
     # Define conversions in x and y from pixels space to meters
-    dist_in_pix = right_fitx[-1] - left_fitx[-1]
+    dist_in_pix = right_fitx[..., -1] - left_fitx[..., -1]
     ym_per_pix = 30/720 # meters per pixel in y dimension
     xm_per_pix = 3.7/dist_in_pix # meters per pixel in x dimension
     
-    left_fit_cr = np.polyfit(ploty*ym_per_pix, left_fitx*xm_per_pix, 2)
-    right_fit_cr = np.polyfit(ploty*ym_per_pix, right_fitx*xm_per_pix, 2)
+    # Both lanes (and all frames) in one fit
+    lanes_x = np.stack((left_fitx, right_fitx)) * np.asarray(xm_per_pix)[..., np.newaxis]
+    fits_cr = fitting.fit_poly2_shared_y(ploty*ym_per_pix, lanes_x)
+    left_fit_cr = fits_cr[0].T
+    right_fit_cr = fits_cr[1].T
     
     y_eval = np.max(ploty) 
     left_curverad = ((1 + (2*left_fit_cr[0]*y_eval*ym_per_pix + left_fit_cr[1])**2)**1.5) / np.absolute(2*left_fit_cr[0])
     right_curverad = ((1 + (2*right_fit_cr[0]*y_eval*ym_per_pix + right_fit_cr[1])**2)**1.5) / np.absolute(2*right_fit_cr[0])
     return left_curverad, right_curverad
+
+# %% [markdown]
+# ## Closed form from the fits
+#
+# With x_m = xm_per_pix * x and y_m = ym_per_pix * y the fit x = A*y**2 + B*y + C becomes
+# x_m = (xm_per_pix / ym_per_pix**2) * A * y_m**2 + (xm_per_pix / ym_per_pix) * B * y_m + xm_per_pix * C,
+# so no re-fit is needed. The functions below take fits of shape (..., 3), e.g. (N, 3) for N frames.
+
+# %%
+def fits_bottom_x(left_fit, right_fit, img_height):
+    """x of the left and right fits (..., 3) at the bottom row of the image."""
+    y = img_height - 1
+    vander = np.array([y**2, y, 1.])
+    return np.dot(left_fit, vander), np.dot(right_fit, vander)
+
+
+def fit_to_meters(fit, xm_per_pix, ym_per_pix):
+    """Coefficients (..., 3) of fit (..., 3) in meters. xm_per_pix can be an array (...,)."""
+    xm_per_pix = np.asarray(xm_per_pix)[..., np.newaxis]
+    return np.asarray(fit) * xm_per_pix / np.array([ym_per_pix**2, ym_per_pix, 1.])
+
+
+def calc_dist_to_center_from_fits(img_width, img_height, left_fit, right_fit):
+    """Same as calc_dist_to_center, computed from the fits (..., 3)."""
+    left_bottom_x, right_bottom_x = fits_bottom_x(left_fit, right_fit, img_height)
+    lane_width = right_bottom_x - left_bottom_x
+    center_lane = (lane_width / 2.0) + left_bottom_x
+    return (center_lane - img_width / 2.) * (3.7 / lane_width)
+
+
+def measure_curvature_real_from_fits(left_fit, right_fit, img_height):
+    """Same as measure_curvature_real, computed from the fits (..., 3) without re-fitting."""
+    left_bottom_x, right_bottom_x = fits_bottom_x(left_fit, right_fit, img_height)
+    ym_per_pix = 30/720 # meters per pixel in y dimension
+    xm_per_pix = 3.7/(right_bottom_x - left_bottom_x) # meters per pixel in x dimension
+    y_eval = (img_height - 1) * ym_per_pix
+    
+    curverads = []
+    for fit in (left_fit, right_fit):
+        fit_cr = fit_to_meters(fit, xm_per_pix, ym_per_pix)
+        a, b = fit_cr[..., 0], fit_cr[..., 1]
+        curverads.append(((1 + (2*a*y_eval + b)**2)**1.5) / np.absolute(2*a))
+    return tuple(curverads)
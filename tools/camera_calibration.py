@@ -20,9 +20,9 @@
 import numpy as np
 import cv2
 from glob import glob as gglob
-import matplotlib.pyplot as plt
 import pickle
 from os.path import join
+from functools import lru_cache
 
 # %%
 class CameraCalibration():
@@ -73,6 +73,7 @@ class CameraCalibration():
                 success += 1
                 if verbose == True:
                     # Draw and display the corners
+                    import matplotlib.pyplot as plt
                     cv2.drawChessboardCorners(img, (self.ny, self.nx), corners, ret)
                     plt.imshow(img)
                     plt.title("{}: {}".format(idx, fname))
@@ -112,14 +113,27 @@ class CameraCalibration():
         print("Calibration result saved in {}".format(path))
 
 # %%
+@lru_cache(maxsize=8)
+def load_calibration(pkl_name):
+    """Load mtx and dist from pickle (pkl_name). Cached, i.e. the file is read only once."""
+    dist_pickle = pickle.load(open(pkl_name, "rb" ))
+    return dist_pickle["mtx"], dist_pickle["dist"]
+
 def undistort_image(img, mtx=None, dist=None, pkl_name=None):
     """Undistort image using mtx and dist or loading saved values from pickle (pkl_name)."""
     if pkl_name:
-        dist_pickle = pickle.load(open(pkl_name, "rb" ))
-        mtx = dist_pickle["mtx"]
-        dist = dist_pickle["dist"]
+        mtx, dist = load_calibration(pkl_name)
     img_undistorted = cv2.undistort(img, mtx, dist, None, mtx)
     return img_undistorted
 
 # %%
+def get_undistort_maps(mtx, dist, img_size):
+    """Precompute remap tables (fixed-point) for undistorting images of img_size=(width, height)."""
+    return cv2.initUndistortRectifyMap(mtx, dist, None, mtx, img_size, cv2.CV_16SC2)
+
+def undistort_image_with_maps(img, maps, out=None):
+    """Undistort image using remap tables from get_undistort_maps."""
+    return cv2.remap(img, maps[0], maps[1], cv2.INTER_LINEAR, dst=out)
+
+# %%
 
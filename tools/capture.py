@@ -0,0 +1,113 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Capture
+#
+# Interim images of the lane detection for debugging. During a frame the
+# pipeline only hands over references (or callables creating an image), the
+# images are copied or created at the end of the frame and only if the frame is
+# kept. Kept frames go to a ring buffer limited in memory.
+
+# %%
+from collections import deque, OrderedDict
+import numpy as np
+
+# %%
+# Stages in pipeline order
+STAGES = ('img_binary_warped', 'img_histogram', 'img_rectangle_warped', 'img_lane_warped',
+          'img_colored_lanes_warp', 'img_colored_plane_warp', 'img_colored_warp', 'img_colored_unwarp',
+          'img_unwarp')
+
+
+class DebugCapture():
+    """Ring buffer of interim images of sampled frames, at most max_bytes (None: no limit).
+    A frame is kept if frame_nb % every == 0 (every=0: never) or if anomaly(result) is true,
+    e.g. anomaly=lambda result: min(result.left_pixel_count, result.right_pixel_count) < 500.
+    Only the given stages are captured (None: all stages, see STAGES).
+
+    >>> capture = DebugCapture(stages=['img_binary_warped'], every=100, max_bytes=64 * 2**20)
+    >>> ld = LaneDetection(mtx, dist, src, dst, capture=capture)
+    """
+    def __init__(self, stages=None, every=1, anomaly=None, max_bytes=256 * 2**20):
+        self.stages = None if stages is None else frozenset(stages)
+        self.every = every
+        self.anomaly = anomaly
+        self.max_bytes = max_bytes
+        # Kept frames (frame_nb, OrderedDict stage -> image), oldest first
+        self.frames = deque()
+        self.nbytes = 0
+        self._frame_nb = None
+        self._pending = OrderedDict()
+
+    def _sampled(self, frame_nb):
+        return self.every > 0 and frame_nb % self.every == 0
+
+    def begin(self, frame_nb):
+        """Start capturing frame frame_nb. Nothing is collected if the frame can't be kept."""
+        active = self._sampled(frame_nb) or self.anomaly is not None
+        self._frame_nb = frame_nb if active else None
+        self._pending = OrderedDict()
+
+    def wants(self, stage):
+        """True if stage of the current frame would be captured."""
+        return self._frame_nb is not None and (self.stages is None or stage in self.stages)
+
+    def add(self, stage, img):
+        """Add img (array, valid until end is called, or callable returning an array) as stage."""
+        if self.wants(stage):
+            self._pending[stage] = img
+
+    def end(self, result=None):
+        """Finish the current frame: keep its images if it is sampled or anomaly(result) is true.
+        Returns the kept images (OrderedDict stage -> image) or None."""
+        frame_nb, pending = self._frame_nb, self._pending
+        self._frame_nb = None
+        self._pending = OrderedDict()
+        if frame_nb is None:
+            return None
+        if not (self._sampled(frame_nb) or (result is not None and self.anomaly(result))):
+            return None
+        imgs = OrderedDict((stage, np.asarray(img()) if callable(img) else np.array(img))
+                           for stage, img in pending.items())
+        nbytes = sum(img.nbytes for img in imgs.values())
+        if self.max_bytes is not None:
+            if nbytes > self.max_bytes:
+                print("Frame {} not captured, its images ({} bytes) exceed max_bytes.".format(frame_nb, nbytes))
+                return None
+            while self.frames and self.nbytes + nbytes > self.max_bytes:
+                self._pop()
+        self.frames.append((frame_nb, imgs))
+        self.nbytes += nbytes
+        return imgs
+
+    def _pop(self):
+        _, imgs = self.frames.popleft()
+        self.nbytes -= sum(img.nbytes for img in imgs.values())
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    @property
+    def latest(self):
+        """Images of the last kept frame (empty if none)."""
+        return self.frames[-1][1] if self.frames else OrderedDict()
+
+    def clear(self):
+        self.frames.clear()
+        self.nbytes = 0
@@ -0,0 +1,117 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Fitting
+#
+# Second order polynomial fits x = a*y**2 + b*y + c (same as `np.polyfit(y, x, 2)`)
+# solved via the 3x3 normal equations. Several lanes are fitted in one call.
+# y is rescaled to about [0, 1] before the sums are taken, to keep the normal
+# equations well conditioned.
+
+# %%
+import numpy as np
+from functools import lru_cache
+
+# %%
+def _solve_normal_equations(A, b):
+    """Solve stacked 3x3 systems A x = b, minimum norm solution if singular (less than 3 points)."""
+    try:
+        return np.linalg.solve(A, b[..., np.newaxis])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.matmul(np.linalg.pinv(A), b[..., np.newaxis])[..., 0]
+
+
+def _unscale(fits_scaled, y_scale):
+    """Coefficients for y from coefficients for y / y_scale."""
+    return fits_scaled / np.array([y_scale**2, y_scale, 1.])
+
+
+def _powers(y, y_scale):
+    """Rows u**k for k=0..4 with u = y / y_scale, shape (5, n)."""
+    u = np.asarray(y, dtype=np.float64) / y_scale
+    powers = np.empty((5, u.shape[0]))
+    powers[0] = 1.
+    powers[1] = u
+    np.multiply(u, u, out=powers[2])
+    np.multiply(powers[2], u, out=powers[3])
+    np.multiply(powers[2], powers[2], out=powers[4])
+    return powers
+
+
+def poly2_sums(y, x, weights=None, y_scale=1.):
+    """Sufficient statistics of a fit of x over u = y / y_scale:
+    s = [sum(w*u**k) for k=0..4] and t = [sum(w*x*u**k) for k=0..2]."""
+    powers = _powers(y, y_scale)
+    wx = np.asarray(x, dtype=np.float64)
+    if weights is None:
+        s = powers.sum(axis=1)
+    else:
+        s = powers.dot(weights)
+        wx = wx * weights
+    t = powers[:3].dot(wx)
+    return s, t
+
+
+def normal_equations(s, t):
+    """Normal equations A fit = b (fit = [a, b, c]) from sums s (..., 5) and t (..., 3)."""
+    idx = 4 - (np.arange(3)[:, np.newaxis] + np.arange(3))
+    return s[..., idx], t[..., ::-1]
+
+
+def fit_poly2(ys, xs, weights=None):
+    """Fit x = a*y**2 + b*y + c to each point set, e.g. ys=(lefty, righty), xs=(leftx, rightx).
+    Optional per-pixel weights minimize sum(w * residual**2) (i.e. np.polyfit(..., w=sqrt(w))).
+    Returns array (len(ys), 3) of [a, b, c]."""
+    if any(len(y) == 0 for y in ys):
+        raise TypeError("expected non-empty vector for x")
+    if weights is None:
+        weights = [None] * len(ys)
+    y_scale = max(max(float(np.max(np.abs(y))) for y in ys), 1.)
+    sums = [poly2_sums(y, x, w, y_scale) for y, x, w in zip(ys, xs, weights)]
+    s = np.array([s for s, _ in sums])
+    t = np.array([t for _, t in sums])
+    A, b = normal_equations(s, t)
+    return _unscale(_solve_normal_equations(A, b), y_scale)
+
+
+def fit_poly2_shared_y(y, xs, weights=None):
+    """Fit x = a*y**2 + b*y + c to each row of xs (..., n), all rows sampled at the same y (n,).
+    Returns array (..., 3) of [a, b, c]."""
+    y_scale = max(float(np.max(np.abs(y))), 1.)
+    powers = _powers(y, y_scale)
+    s = powers.sum(axis=1) if weights is None else powers.dot(weights)
+    wxs = xs if weights is None else xs * weights
+    t = np.matmul(wxs, powers[:3].T)
+    A, b = normal_equations(s, t)
+    A = np.broadcast_to(A, t.shape + (3,))
+    return _unscale(_solve_normal_equations(A, b), y_scale)
+
+
+# %%
+@lru_cache(maxsize=8)
+def get_ploty_and_vander(img_height):
+    """ploty (all rows of an image) and its rows [y**2, y, 1] (cached, read-only)."""
+    ploty = np.linspace(0, img_height-1, img_height)
+    vander = np.column_stack((ploty**2, ploty, np.ones_like(ploty)))
+    ploty.setflags(write=False)
+    vander.setflags(write=False)
+    return ploty, vander
+
+
+def eval_poly2(fits, img_height):
+    """x values of fits (..., 3) at every row of an image, shape (..., img_height)."""
+    _, vander = get_ploty_and_vander(img_height)
+    return np.matmul(fits, vander.T)
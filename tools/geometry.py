@@ -0,0 +1,172 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Geometry
+#
+# Camera calibration, perspective transform and precomputed remap tables in one
+# on-disk artifact. Arrays are stored as `.npy` files and memory-mapped on load,
+# so all processes on a host share the same pages.
+
+# %%
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+import numpy as np
+from os.path import join, isdir
+
+from tools import camera_calibration
+from tools import perspective_transform as pt
+
+# %%
+# Bump if the way remap tables are built changes (invalidates old caches)
+GEOMETRY_VERSION = 3
+
+def get_geometry_key(mtx, dist, src, dst, img_size, scale=1.):
+    """Hash of all inputs the geometry is derived from."""
+    h = hashlib.sha1("v{}".format(GEOMETRY_VERSION).encode())
+    for arr in (mtx, dist, src, dst, img_size, scale):
+        arr = np.ascontiguousarray(arr, dtype=np.float64)
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+# %%
+class CameraGeometry():
+    """Camera geometry with precomputed remap tables for one image size.
+
+    The warp maps undistort and warp in one step and only read from the region 
+    of interest (roi), i.e. they have to be applied to img[geometry.roi_slices].
+    The warped (bird's-eye) image is scaled by warp_scale, i.e. has size warp_size.
+
+    >>> geometry = CameraGeometry.load_or_create("geometry_cache", mtx, dist, src, dst, (1280, 720))
+    >>> img_binary_warped = pt.remap_img(img_binary[geometry.roi_slices], geometry.warp_maps)
+    """
+    # Number of geometries kept by shared()
+    SHARED_MAX = 8
+    ARRAY_NAMES = ("mtx", "dist", "src", "dst", "img_size", "M", "Minv",
+                   "undistort_map1", "undistort_map2", "roi", "warp_scale", "warp_map1", "warp_map2")
+
+    def __init__(self, key, **arrays):
+        self.key = key
+        for name in self.ARRAY_NAMES:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def create(cls, mtx, dist, src, dst, img_size, scale=1.):
+        """Compute transformation matrices and remap tables (the inputs are copied)."""
+        mtx, dist, src, dst = (np.array(arr, copy=True) for arr in (mtx, dist, src, dst))
+        img_size = tuple(int(v) for v in img_size)
+        M, Minv = pt.get_perspective_transform_matrices(None, src, dst)
+        undistort_map1, undistort_map2 = camera_calibration.get_undistort_maps(mtx, dist, img_size)
+        # Warp maps are relative to the region of interest (ROI)
+        warp_size = (int(round(img_size[0] * scale)), int(round(img_size[1] * scale)))
+        M_warp = pt.get_scaling_matrix(scale).dot(M)
+        warp_maps = pt.get_undistort_and_warp_maps(mtx, dist, M_warp, warp_size)
+        roi, (warp_map1, warp_map2) = pt.crop_maps_to_roi(warp_maps, img_size)
+        return cls(get_geometry_key(mtx, dist, src, dst, img_size, scale),
+                   mtx=mtx, dist=dist, src=src, dst=dst, img_size=np.int64(img_size), M=M, Minv=Minv,
+                   undistort_map1=undistort_map1, undistort_map2=undistort_map2, roi=np.int64(roi), 
+                   warp_scale=np.float64(scale), warp_map1=warp_map1, warp_map2=warp_map2)
+
+    @property
+    def size(self):
+        """Image size as (width, height)."""
+        return (int(self.img_size[0]), int(self.img_size[1]))
+
+    @property
+    def warp_size(self):
+        """Size of the warped image as (width, height)."""
+        return (self.warp_map1.shape[1], self.warp_map1.shape[0])
+
+    @property
+    def Minv_warp(self):
+        """Matrix to unwarp the (scaled) warped image to the full-size undistorted image."""
+        return np.asarray(self.Minv).dot(pt.get_scaling_matrix(1. / float(self.warp_scale)))
+
+    @property
+    def roi_slices(self):
+        """Slices (rows, columns) of the region of interest the warp maps read from."""
+        x0, y0, x1, y1 = (int(v) for v in self.roi)
+        return slice(y0, y1), slice(x0, x1)
+
+    @property
+    def undistort_maps(self):
+        return self.undistort_map1, self.undistort_map2
+
+    @property
+    def warp_maps(self):
+        return self.warp_map1, self.warp_map2
+
+    def save(self, cache_dir):
+        """Save all arrays to cache_dir/<key>/. Writing is atomic, concurrent writers are fine."""
+        path = join(cache_dir, self.key)
+        if isdir(path):
+            return path
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = join(cache_dir, ".{}.{}.tmp".format(self.key, os.getpid()))
+        os.makedirs(tmp_path, exist_ok=True)
+        for name in self.ARRAY_NAMES:
+            np.save(join(tmp_path, name + ".npy"), np.asarray(getattr(self, name)))
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process was faster
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """Load (memory-mapped, read-only) geometry saved with save()."""
+        arrays = {name: np.load(join(path, name + ".npy"), mmap_mode="r") for name in cls.ARRAY_NAMES}
+        return cls(os.path.basename(os.path.normpath(path)), **arrays)
+
+    @classmethod
+    def load_or_create(cls, cache_dir, mtx, dist, src, dst, img_size, scale=1.):
+        """Load geometry from cache_dir or create and save it if not cached yet."""
+        path = join(cache_dir, get_geometry_key(mtx, dist, src, dst, img_size, scale))
+        if not isdir(path):
+            cls.create(mtx, dist, src, dst, img_size, scale).save(cache_dir)
+        return cls.load(path)
+
+    @classmethod
+    def shared(cls, mtx, dist, src, dst, img_size, scale=1., cache_dir=None):
+        """Geometry shared by all users in this process (read-only), created (or loaded from 
+        cache_dir if given) on first use. Streams of the same camera model use the same arrays.
+        The last SHARED_MAX geometries are kept, older ones are freed once no user holds them anymore."""
+        key = (get_geometry_key(mtx, dist, src, dst, img_size, scale), cache_dir)
+        with _shared_lock:
+            geometry = _shared.get(key)
+            if geometry is not None:
+                _shared.move_to_end(key)
+            else:
+                if cache_dir:
+                    geometry = cls.load_or_create(cache_dir, mtx, dist, src, dst, img_size, scale)
+                else:
+                    geometry = cls.create(mtx, dist, src, dst, img_size, scale)
+                    for name in cls.ARRAY_NAMES:
+                        getattr(geometry, name).setflags(write=False)
+                _shared[key] = geometry
+                while len(_shared) > cls.SHARED_MAX:
+                    _shared.popitem(last=False)
+        return geometry
+
+
+# Geometries shared in this process, by (key, cache_dir), least recently used first
+_shared = OrderedDict()
+_shared_lock = threading.Lock()
@@ -18,51 +18,48 @@
 
 # %%
 import numpy as np
-import matplotlib.image as mpimg
-import matplotlib.pyplot as plt
 import cv2
 
+from tools import fitting
+from tools.arena import FrameArena
+from tools.pixels import PixelSet
+
 # %%
-def find_lane_pixels_in_boxes(binary_warped, return_img=False):
-    """
+def find_lane_pixels_in_boxes(binary_warped, return_img=False, nwindows=9, margin=100, minpix=50, pixels=None):
+    """Find lane pixels using nwindows sliding windows of width 2*margin per lane.
+    A window is recentered if it contains more than minpix pixels.
+    pixels: PixelSet of binary_warped (computed if not given). Each window only looks at 
+    the pixels of its own row band, i.e. the total cost is linear in the number of pixels.
     """
+    if pixels is None:
+        pixels = PixelSet.from_image(binary_warped)
+    img_height = binary_warped.shape[0]
     # Take a histogram of the bottom half of the image
-    histogram = np.sum(binary_warped[binary_warped.shape[0]//2:, :], axis=0)
+    histogram = pixels.histogram(img_height//2)
     # Create an output image to draw on and visualize the result
     if return_img:
         out_img = np.dstack((binary_warped, binary_warped, binary_warped)) * 255
     # Find the peak of the left and right halves of the histogram
     # These will be the starting point for the left and right lines
-    midpoint = np.int(histogram.shape[0]//2)
+    midpoint = int(histogram.shape[0]//2)
     leftx_base = np.argmax(histogram[:midpoint])
     rightx_base = np.argmax(histogram[midpoint:]) + midpoint
 
-    # Choose the number of sliding windows
-    nwindows = 9
-    # Set the width of the windows +/- margin
-    margin = 100
-    # Set minimum number of pixels found to recenter window
-    minpix = 50
-
     # Set height of windows - based on nwindows above and image shape
-    window_height = np.int(binary_warped.shape[0]//nwindows)
-    # Identify the x and y positions of all nonzero pixels in the image
-    nonzero = binary_warped.nonzero()
-    nonzeroy = np.array(nonzero[0])
-    nonzerox = np.array(nonzero[1])
+    window_height = int(img_height//nwindows)
     # Current positions to be updated later for each window in nwindows
     leftx_current = leftx_base
     rightx_current = rightx_base
 
-    # Create empty lists to receive left and right lane pixel indices
-    left_lane_inds = []
-    right_lane_inds = []
+    # Create empty lists to receive left and right lane pixels (x and y)
+    left_lane_x, left_lane_y = [], []
+    right_lane_x, right_lane_y = [], []
 
     # Step through the windows one by one
     for window in range(nwindows):
         # Identify window boundaries in x and y (and right and left)
-        win_y_low = binary_warped.shape[0] - (window+1) * window_height
-        win_y_high = binary_warped.shape[0] - window * window_height
+        win_y_low = img_height - (window+1) * window_height
+        win_y_high = img_height - window * window_height
         win_xleft_low = leftx_current - margin
         win_xleft_high = leftx_current + margin
         win_xright_low = rightx_current - margin
@@ -70,37 +67,32 @@ def find_lane_pixels_in_boxes(binary_warped, return_img=False):
         
         # Draw the windows on the visualization image
         if return_img:
-            cv2.rectangle(out_img, (win_xleft_low, win_y_low), (win_xleft_high, win_y_high), (0, 255, 0), 2) 
-            cv2.rectangle(out_img, (win_xright_low, win_y_low), (win_xright_high, win_y_high), (0, 255, 0), 2) 
+            cv2.rectangle(out_img, (int(win_xleft_low), win_y_low), (int(win_xleft_high), win_y_high), (0, 255, 0), 2) 
+            cv2.rectangle(out_img, (int(win_xright_low), win_y_low), (int(win_xright_high), win_y_high), (0, 255, 0), 2) 
         
-        # Identify the nonzero pixels in x and y within the window #
-        good_left_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & 
-        (nonzerox >= win_xleft_low) &  (nonzerox < win_xleft_high)).nonzero()[0]
-        good_right_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & 
-        (nonzerox >= win_xright_low) &  (nonzerox < win_xright_high)).nonzero()[0]
+        # Pixels in the row band of the window
+        band = pixels.rows(win_y_low, win_y_high)
+        band_x, band_y = pixels.x[band], pixels.y[band]
+        # Identify the pixels within the window
+        good_left = (band_x >= win_xleft_low) & (band_x < win_xleft_high)
+        good_right = (band_x >= win_xright_low) & (band_x < win_xright_high)
+        good_left_x, good_right_x = band_x[good_left], band_x[good_right]
         
-        # Append these indices to the lists
-        left_lane_inds.append(good_left_inds)
-        right_lane_inds.append(good_right_inds)
+        # Append these pixels to the lists
+        left_lane_x.append(good_left_x)
+        left_lane_y.append(band_y[good_left])
+        right_lane_x.append(good_right_x)
+        right_lane_y.append(band_y[good_right])
         
         # If you found > minpix pixels, recenter next window on their mean position
-        if len(good_left_inds) > minpix:
-            leftx_current = np.int(np.mean(nonzerox[good_left_inds]))
-        if len(good_right_inds) > minpix:        
-            rightx_current = np.int(np.mean(nonzerox[good_right_inds]))
-
-    # Concatenate the arrays of indices (previously was a list of lists of pixels)
-    try:
-        left_lane_inds = np.concatenate(left_lane_inds)
-        right_lane_inds = np.concatenate(right_lane_inds)
-    except ValueError:
-        pass
+        if len(good_left_x) > minpix:
+            leftx_current = int(np.mean(good_left_x))
+        if len(good_right_x) > minpix:        
+            rightx_current = int(np.mean(good_right_x))
 
     # Extract left and right line pixel positions
-    leftx = nonzerox[left_lane_inds]
-    lefty = nonzeroy[left_lane_inds] 
-    rightx = nonzerox[right_lane_inds]
-    righty = nonzeroy[right_lane_inds]
+    leftx, lefty = np.concatenate(left_lane_x), np.concatenate(left_lane_y)
+    rightx, righty = np.concatenate(right_lane_x), np.concatenate(right_lane_y)
 
     if return_img:
         return leftx, lefty, rightx, righty, out_img, histogram
@@ -108,24 +100,16 @@ def find_lane_pixels_in_boxes(binary_warped, return_img=False):
         return leftx, lefty, rightx, righty, None, None
 
 # %%
-def detect_initial_lane_line(img_binary_warped, return_img=False):
+def detect_initial_lane_line(img_binary_warped, return_img=False, nwindows=9, margin=100, minpix=50, pixels=None):
     # Find our lane pixels first
-    leftx, lefty, rightx, righty, out_img, hist = find_lane_pixels_in_boxes(img_binary_warped, return_img)
+    leftx, lefty, rightx, righty, out_img, hist = find_lane_pixels_in_boxes(img_binary_warped, return_img,
+                                                                            nwindows, margin, minpix, pixels)
     
-    # Fit a second order polynomial to each using `np.polyfit`
-    left_fit = np.polyfit(lefty, leftx, 2)
-    right_fit = np.polyfit(righty, rightx, 2)
+    # Fit a second order polynomial to both lanes at once
+    left_fit, right_fit = fitting.fit_poly2((lefty, righty), (leftx, rightx))
 
     # Generate x and y values for plotting
-    ploty = np.linspace(0, img_binary_warped.shape[0]-1, img_binary_warped.shape[0] )
-    try:
-        left_fitx = left_fit[0]*ploty**2 + left_fit[1]*ploty + left_fit[2]
-        right_fitx = right_fit[0]*ploty**2 + right_fit[1]*ploty + right_fit[2]
-    except TypeError:
-        # Avoids an error if `left` and `right_fit` are still none or incorrect
-        print('The function failed to fit a line!')
-        left_fitx = 1*ploty**2 + 1*ploty
-        right_fitx = 1*ploty**2 + 1*ploty
+    left_fitx, right_fitx, ploty = get_x_and_y_of_fits(img_binary_warped.shape[0], left_fit, right_fit)
 
     # Visualization
     if return_img:
@@ -154,42 +138,67 @@ def detect_initial_lane_line(img_binary_warped, return_img=False):
     else:
         return left_fit, right_fit, None, None
 
+# %%
+def scale_fit(fit, scale):
+    """Coefficients of polynomial fit x = f(y) after scaling x and y by scale."""
+    return np.array([fit[0] / scale, fit[1], fit[2] * scale])
+
 # %%
 def get_x_and_y_of_fits(img_height, left_fit, right_fit):
-    # Generate x and y values for plotting
-    ploty = np.linspace(0, img_height-1, img_height)
-    left_fitx = left_fit[0] * ploty**2 + left_fit[1] * ploty + left_fit[2]
-    right_fitx = right_fit[0] * ploty**2 + right_fit[1] * ploty + right_fit[2]
+    # Generate x and y values for plotting (ploty is cached and read-only)
+    ploty, _ = fitting.get_ploty_and_vander(img_height)
+    left_fitx, right_fitx = fitting.eval_poly2(np.array([left_fit, right_fit]), img_height)
     return left_fitx, right_fitx, ploty
 
 # %%
-def detect_further_lane_line(img_binary_warped, left_fit, right_fit, return_img=False):
-    # Choose the width of the margin around the previous polynomial to search
-    # The quiz grader expects 100 here, but feel free to tune on your own!
-    margin = 100
-
-    # Grab activated pixels
-    nonzero = img_binary_warped.nonzero()
-    nonzeroy = np.array(nonzero[0])
-    nonzerox = np.array(nonzero[1])
-    
-    ### Set the area of search based on activated x-values within the +/- margin of our polynomial function
-    left_lane_inds = ((nonzerox > (left_fit[0]*(nonzeroy**2) + left_fit[1]*nonzeroy + 
-                    left_fit[2] - margin)) & (nonzerox < (left_fit[0]*(nonzeroy**2) + 
-                    left_fit[1]*nonzeroy + left_fit[2] + margin)))
-    right_lane_inds = ((nonzerox > (right_fit[0]*(nonzeroy**2) + right_fit[1]*nonzeroy + 
-                    right_fit[2] - margin)) & (nonzerox < (right_fit[0]*(nonzeroy**2) + 
-                    right_fit[1]*nonzeroy + right_fit[2] + margin)))
-    
-    # Again, extract left and right line pixel positions
-    leftx = nonzerox[left_lane_inds]
-    lefty = nonzeroy[left_lane_inds] 
-    rightx = nonzerox[right_lane_inds]
-    righty = nonzeroy[right_lane_inds]
+def find_lane_pixels_in_corridor(img_binary_warped, fit, margin=100, arena=None):
+    """Find nonzero pixels x, y with fit(y) - margin < x < fit(y) + margin.
+    Only the corridor of each row is read, pixels outside are never touched.
+    arena: FrameArena for the (height, 2*margin + 1) scratch arrays (allocated per call if None)."""
+    if arena is None:
+        arena = FrameArena()
+    img_height, img_width = img_binary_warped.shape
+    ys = np.arange(img_height)
+    fit = np.asarray(fit, dtype=np.float64)
+    fitx = fit[0]*(ys**2) + fit[1]*ys + fit[2]
+    fitx[np.isnan(fitx)] = -np.inf  # no pixel matches
+    # Integer column interval [first, last] of each row (at most 2*margin + 1 columns)
+    first = np.floor(np.clip(fitx - margin, -1, img_width)).astype(np.int64) + 1
+    last = np.ceil(np.clip(fitx + margin, 0, img_width)).astype(np.int64) - 1
+    last = np.minimum(last, img_width - 1)
+    offsets = np.arange(2*margin + 1)
+    shape = (img_height, len(offsets))
+    # Flat index of the corridor columns (intp, so np.take does not convert it), kept within each row
+    row_offsets = ys * img_width
+    index = arena.get('corridor_index', shape, np.intp)
+    np.add((row_offsets + first)[:, np.newaxis], offsets, out=index)
+    np.minimum(index, (row_offsets + img_width - 1)[:, np.newaxis], out=index)
+    values = np.take(img_binary_warped.reshape(-1), index, out=arena.get('corridor_values', shape), mode='clip')
+    in_corridor = np.less_equal(offsets, (last - first)[:, np.newaxis], out=arena.get('corridor_mask', shape, bool))
+    np.logical_and(in_corridor, values, out=in_corridor)
+    rows, offsets = np.nonzero(in_corridor)
+    return first[rows] + offsets, rows
+
+def find_lane_pixels_around_fits(img_binary_warped, fits, margin=100, pixels=None, arena=None):
+    """Pixels ((leftx, lefty), (rightx, righty)) in the corridors around fits (left_fit, right_fit).
+    Taken from pixels (PixelSet of img_binary_warped) if given, otherwise only the corridors are read
+    (with the scratch arrays of arena)."""
+    if pixels is not None:
+        return tuple(pixels.in_corridor(fit, margin) for fit in fits)
+    if arena is None:
+        arena = FrameArena()
+    return tuple(find_lane_pixels_in_corridor(img_binary_warped, fit, margin, arena) for fit in fits)
+
+# %%
+def detect_further_lane_line(img_binary_warped, left_fit, right_fit, return_img=False, margin=100, pixels=None):
+    # margin: width of the margin around the previous polynomial to search
+    # pixels: PixelSet of img_binary_warped (only the corridors are read if not given)
+    ### Activated pixels within the +/- margin of our polynomial function
+    (leftx, lefty), (rightx, righty) = find_lane_pixels_around_fits(img_binary_warped, (left_fit, right_fit),
+                                                                    margin, pixels)
     
     # Fit new polynomials
-    left_fit = np.polyfit(lefty, leftx, 2)
-    right_fit = np.polyfit(righty, rightx, 2)
+    left_fit, right_fit = fitting.fit_poly2((lefty, righty), (leftx, rightx))
     img_height = img_binary_warped.shape[0]
     left_fitx, right_fitx, ploty = get_x_and_y_of_fits(img_height, left_fit, right_fit)
     
@@ -200,8 +209,8 @@ def detect_further_lane_line(img_binary_warped, left_fit, right_fit, return_img=
         out_img = np.dstack((img_binary_warped, img_binary_warped, img_binary_warped)) * 255
         window_img = np.zeros_like(out_img)
         # Color in left and right line pixels
-        out_img[nonzeroy[left_lane_inds], nonzerox[left_lane_inds]] = [255, 0, 0]
-        out_img[nonzeroy[right_lane_inds], nonzerox[right_lane_inds]] = [0, 0, 255]
+        out_img[lefty, leftx] = [255, 0, 0]
+        out_img[righty, rightx] = [0, 0, 255]
 
     # Generate a polygon to illustrate the search window area
     # And recast the x and y points into usable format for cv2.fillPoly()
@@ -240,9 +249,9 @@ def detect_further_lane_line(img_binary_warped, left_fit, right_fit, return_img=
     ## End visualization steps ##
     fits = (left_fit, right_fit)
     lanes_xy = (left_fitx, right_fitx, ploty)
-    lanes_inds = (left_lane_inds, right_lane_inds)
+    lanes_pixels = ((leftx, lefty), (rightx, righty))
     lines_pts = (left_line_pts, right_line_pts)
     if return_img:
-        return fits, lanes_xy, lanes_inds, lines_pts, out_img
+        return fits, lanes_xy, lanes_pixels, lines_pts, out_img
     else:
-        return fits, lanes_xy, lanes_inds, lines_pts, None
+        return fits, lanes_xy, lanes_pixels, lines_pts, None
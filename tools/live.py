@@ -0,0 +1,202 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Live
+#
+# asyncio front end for live cameras, where fresh results matter more than
+# processing every frame. Each stream has a bounded queue of waiting frames,
+# if it is full the oldest frame is dropped ("latest frame wins"), and frames
+# which waited longer than `max_age` are dropped instead of processed. The
+# detection itself runs on the threads of a `StreamEngine`, so the event loop
+# is never blocked.
+#
+# Per stream, the counts of submitted, processed, dropped and failed frames and
+# the end-to-end latency (submit or capture time until result) are recorded,
+# the latency in a `StageTimer` with the stages `queue` (waiting), `detect` and
+# `latency` (total).
+
+# %%
+import time
+import asyncio
+from collections import deque
+
+from tools.streams import StreamEngine
+from tools.timing import StageTimer
+
+# %%
+class _LiveStream():
+    """Waiting frames (img, timestamp, future), worker task and metrics of one stream."""
+    def __init__(self, queue_size, window):
+        self.queue = deque()
+        self.queue_size = queue_size
+        self.ready = asyncio.Event()
+        self.task = None
+        self.waiters = []
+        self.latest = None
+        self.timer = StageTimer(window)
+        self.counts = {"submitted": 0, "processed": 0, "dropped_full": 0, "dropped_stale": 0, "errors": 0}
+
+
+class LiveLaneDetection():
+    """Asynchronous lane detection of live streams with bounded queues of queue_size frames.
+    Frames older than max_age seconds (None: no limit) when their turn comes are dropped.
+    engine: StreamEngine running the detections (a new one with workers threads if None).
+    Create and use it inside a running event loop.
+
+    >>> live = LiveLaneDetection(workers=4)
+    >>> live.add_stream("cam1", LaneDetection(mtx, dist, src, dst, render_every=0))
+    >>> result = await live.detect("cam1", img)   # LaneResult, None if the frame was dropped
+    """
+    def __init__(self, engine=None, workers=None, queue_size=1, max_age=None, window=1000):
+        if queue_size < 1:
+            raise ValueError("queue_size has to be at least 1")
+        self.own_engine = engine is None
+        self.engine = StreamEngine(workers) if engine is None else engine
+        self.queue_size = queue_size
+        self.max_age = max_age
+        self.window = window
+        self.streams = {}
+
+    def add_stream(self, stream_id, lane_detection, queue_size=None):
+        """Add stream stream_id, detected with lane_detection, and start its worker task."""
+        self.engine.add_stream(stream_id, lane_detection)
+        stream = _LiveStream(queue_size or self.queue_size, self.window)
+        stream.task = asyncio.get_running_loop().create_task(self._run(stream_id, stream))
+        self.streams[stream_id] = stream
+
+    async def remove_stream(self, stream_id):
+        """Stop stream stream_id, its waiting frames are dropped. Returns its LaneDetection."""
+        stream = self.streams.pop(stream_id)
+        stream.task.cancel()
+        try:
+            await stream.task
+        except asyncio.CancelledError:
+            pass
+        self._drop_all(stream)
+        return self.engine.remove_stream(stream_id)
+
+    def submit(self, stream_id, img, timestamp=None):
+        """Queue img of stream stream_id, returns an asyncio future of its LaneResult (None if dropped).
+        timestamp: capture time (time.monotonic()) for the latency, default now."""
+        stream = self.streams[stream_id]
+        future = asyncio.get_running_loop().create_future()
+        if len(stream.queue) >= stream.queue_size:
+            self._drop(stream, "dropped_full")
+        stream.queue.append((img, time.monotonic() if timestamp is None else timestamp, future))
+        stream.counts["submitted"] += 1
+        stream.ready.set()
+        return future
+
+    async def detect(self, stream_id, img, timestamp=None):
+        """Detect lanes in img of stream stream_id, returns the LaneResult or None if the frame was dropped."""
+        return await self.submit(stream_id, img, timestamp)
+
+    async def next_result(self, stream_id):
+        """Wait for the next LaneResult of stream stream_id (of any submitter)."""
+        future = asyncio.get_running_loop().create_future()
+        self.streams[stream_id].waiters.append(future)
+        return await future
+
+    def latest(self, stream_id):
+        """Last LaneResult of stream stream_id (None before the first one)."""
+        return self.streams[stream_id].latest
+
+    def _drop(self, stream, reason):
+        _, _, future = stream.queue.popleft()
+        stream.counts[reason] += 1
+        if not future.done():
+            future.set_result(None)
+
+    def _drop_all(self, stream):
+        while stream.queue:
+            _, _, future = stream.queue.popleft()
+            if not future.done():
+                future.set_result(None)
+
+    async def _run(self, stream_id, stream):
+        """Process the waiting frames of stream one after another (oldest first)."""
+        while True:
+            if not stream.queue:
+                stream.ready.clear()
+                await stream.ready.wait()
+                continue
+            img, timestamp, future = stream.queue[0]
+            start = time.monotonic()
+            if self.max_age is not None and start - timestamp > self.max_age:
+                self._drop(stream, "dropped_stale")
+                continue
+            stream.queue.popleft()
+            if future.done():  # cancelled by the submitter
+                continue
+            try:
+                result = await asyncio.wrap_future(self.engine.submit(stream_id, img))
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                stream.counts["errors"] += 1
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            end = time.monotonic()
+            stream.counts["processed"] += 1
+            stream.timer.add("queue", start - timestamp)
+            stream.timer.add("detect", end - start)
+            stream.timer.add("latency", end - timestamp)
+            stream.latest = result
+            if not future.done():
+                future.set_result(result)
+            waiters, stream.waiters = stream.waiters, []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(result)
+
+    def metrics(self):
+        """Dict stream_id -> frame counts, queue length and latency statistics in ms (see StageTimer.stats)."""
+        metrics = {}
+        for stream_id, stream in self.streams.items():
+            counts = dict(stream.counts, dropped=stream.counts["dropped_full"] + stream.counts["dropped_stale"],
+                          queued=len(stream.queue))
+            metrics[stream_id] = dict(counts, latency=stream.timer.stats())
+        return metrics
+
+    def to_text(self, prefix="lane_detection_live"):
+        """Metrics in the Prometheus text format (latencies in seconds)."""
+        lines = ["# TYPE {}_frames_total counter".format(prefix)]
+        for stream_id, stream in self.streams.items():
+            for name, value in stream.counts.items():
+                lines.append('{}_frames_total{{stream="{}",outcome="{}"}} {}'.format(prefix, stream_id, name, value))
+        lines.append("# TYPE {}_latency_seconds summary".format(prefix))
+        for stream_id, stream in self.streams.items():
+            for stage, s in stream.timer.stats().items():
+                for q in StageTimer.QUANTILES:
+                    lines.append('{}_latency_seconds{{stream="{}",stage="{}",quantile="{}"}} {:.6g}'.format(
+                        prefix, stream_id, stage, q / 100., s["p{}".format(q)] / 1e3))
+        return "\n".join(lines) + "\n"
+
+    async def close(self):
+        """Stop all streams (waiting frames are dropped) and the engine if it was created here."""
+        for stream_id in list(self.streams):
+            await self.remove_stream(stream_id)
+        if self.own_engine:
+            self.engine.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
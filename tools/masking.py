@@ -16,32 +16,41 @@
 
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
+import threading
+from functools import lru_cache
 
 
 # ### masks
 
-def mask_white_from_LUV(img_luv, thresholds=(225, 255)):
+def _zeros_like(arr, out=None):
+    """Same as np.zeros_like(arr), but reuses out if given."""
+    if out is None:
+        return np.zeros_like(arr)
+    out.fill(0)
+    return out
+
+
+def mask_white_from_LUV(img_luv, thresholds=(225, 255), out=None):
     """Extract the white parts of an image using L channel of an LUV image. 
     Function returns a binary mask (2D numpy array)."""
     l_channel = img_luv[:,:,0]
-    channel_l_binary = np.zeros_like(l_channel)
+    channel_l_binary = _zeros_like(l_channel, out)
     channel_l_binary[(l_channel >= thresholds[0]) & (l_channel <= thresholds[1])] = 1
     return channel_l_binary
 
 
-def mask_yellow_from_LAB(img_lab, thresholds=(155, 200)):
+def mask_yellow_from_LAB(img_lab, thresholds=(155, 200), out=None):
     """Extract the yellow parts of an image using B channel of an LAB image. 
     Function returns a binary mask (2D numpy array)."""
     b_channel = img_lab[:,:,2]
-    channel_b_binary = np.zeros_like(b_channel)
+    channel_b_binary = _zeros_like(b_channel, out)
     channel_b_binary[(b_channel >= thresholds[0]) & (b_channel <= thresholds[1])] = 1
     return channel_b_binary
 
 
-def mask_bright_from_HLS(img_hls, thresholds=(200, 255)):
+def mask_bright_from_HLS(img_hls, thresholds=(200, 255), out=None):
     s_channel = img_hls[:,:,2]
-    channel_s_binary = np.zeros_like(s_channel)
+    channel_s_binary = _zeros_like(s_channel, out)
     channel_s_binary[(s_channel >= thresholds[0]) & (s_channel <= thresholds[1])] = 1
     return channel_s_binary
 
@@ -66,10 +75,9 @@ def mask_sobel_from_HLS(img_hls, deriv="x", thresholds=(20, 100)):
 
 # ### combine functions
 
-def combine_masks(*args): 
+def combine_masks(*args, out=None): 
     """Combine several masks (2d numpy arrays) to show all active pixels."""
-    combined_binary = np.zeros_like(args[0])
-    print
+    combined_binary = _zeros_like(args[0], out)
     for arg in args:
         combined_binary[(arg == 1)] = 1
     return combined_binary
@@ -86,24 +94,81 @@ def combine_masks_in_color(*args):
     return img_color
 
 
-def get_yellow_white_and_bright_pixel_mask(img):
+def get_yellow_white_and_bright_pixel_mask(img, white_thresholds=(225, 255), yellow_thresholds=(155, 200), 
+                                           bright_thresholds=(200, 255), use_lut=True, out=None, buffer=None, 
+                                           index=None):
     """Get a binary mask of pixels which might be lane pixels, 
-    i.e. yellow, white and bright pixels."""
+    i.e. yellow, white and bright pixels.
+    With use_lut the mask is looked up per RGB color (same result, faster).
+    The mask is written to out, buffer and index are used as intermediate BGRA image and lookup index 
+    if given (see apply_color_lut)."""
+    if use_lut:
+        with _lut_lock:  # threads wait for the first build instead of building it too
+            lut = get_yellow_white_and_bright_lut(tuple(white_thresholds), tuple(yellow_thresholds), 
+                                                  tuple(bright_thresholds))
+        return apply_color_lut(img, lut, out=out, buffer=buffer, index=index)
     # white
     img_luv = cv2.cvtColor(img, cv2.COLOR_RGB2LUV)
-    img_white = mask_white_from_LUV(img_luv, thresholds=(225, 255))
+    img_white = mask_white_from_LUV(img_luv, thresholds=white_thresholds)
     # yellow
     img_lab = cv2.cvtColor(img, cv2.COLOR_RGB2LAB)
-    img_yellow = mask_yellow_from_LAB(img_lab)
+    img_yellow = mask_yellow_from_LAB(img_lab, thresholds=yellow_thresholds)
     # bright
     img_hls = cv2.cvtColor(img, cv2.COLOR_RGB2HLS)
-    img_bright = mask_bright_from_HLS(img_hls)
+    img_bright = mask_bright_from_HLS(img_hls, thresholds=bright_thresholds)
     # combine
-    img_combined_binary = combine_masks(img_white, img_yellow, img_bright)
+    img_combined_binary = combine_masks(img_white, img_yellow, img_bright, out=out)
     return img_combined_binary
 
+
+# ### lookup table
+
+_lut_lock = threading.Lock()
+
+
+@lru_cache(maxsize=8)
+def get_yellow_white_and_bright_lut(white_thresholds=(225, 255), yellow_thresholds=(155, 200), 
+                                    bright_thresholds=(200, 255)):
+    """Lookup table (2**24 entries) with the mask value of each RGB color, index is r*65536 + g*256 + b. 
+    Built once per thresholds using the color conversions of get_yellow_white_and_bright_pixel_mask."""
+    lut = np.empty((256, 256 * 256), np.uint8)
+    # All (g, b) combinations for one r value
+    img_gb = np.empty((256, 256, 3), np.uint8)
+    img_gb[:, :, 1], img_gb[:, :, 2] = np.mgrid[0:256, 0:256]
+    for r in range(256):
+        img_gb[:, :, 0] = r
+        lut[r] = get_yellow_white_and_bright_pixel_mask(img_gb, white_thresholds, yellow_thresholds, 
+                                                        bright_thresholds, use_lut=False).reshape(-1)
+    lut = lut.reshape(-1)
+    lut.setflags(write=False)
+    return lut
+
+
+def apply_color_lut(img, lut, out=None, buffer=None, index=None):
+    """Look up the value of each RGB pixel in lut (see get_yellow_white_and_bright_lut).
+    Optionally write to out, use buffer (uint8, shape (h, w, 4)) for the intermediate BGRA image
+    and index (intp, shape (h, w)) for the lookup index (np.take converts other index types to a new
+    intp array on every call). img can also be a stack of images (n, h, w, 3)."""
+    if img.ndim > 3:
+        # Process stack as one tall image (copies img only if it is not contiguous)
+        mask_shape = img.shape[:-1]
+        img = img.reshape((-1,) + img.shape[-2:])
+        buffer = None if buffer is None else buffer.reshape(img.shape[:-1] + (4,))
+        out = None if out is None else out.reshape(img.shape[:-1])
+        index = None if index is None else index.reshape(img.shape[:-1])
+        return apply_color_lut(img, lut, out=out, buffer=buffer, index=index).reshape(mask_shape)
+    # BGRA bytes read as little-endian uint32 give alpha*2**24 + r*65536 + g*256 + b
+    img_bgra = cv2.cvtColor(img, cv2.COLOR_RGB2BGRA, dst=buffer)
+    idx = img_bgra.view(np.uint32)[:, :, 0]
+    if index is None:
+        index = np.empty(idx.shape, np.intp)
+    np.bitwise_and(idx, 0xFFFFFF, out=index, casting="unsafe")
+    return np.take(lut, index, out=out, mode="clip")
+
+
 def plot_thresholds(img, fct, min_list, max_list, figsize=(15, 50)):
     """Plot all min_list and max_list combinations applied to img using fct."""
+    import matplotlib.pyplot as plt
     fig, axes = plt.subplots(len(min_list), len(max_list), figsize=figsize)
     for i, iv in enumerate(min_list):
         for j, jv in enumerate(max_list):
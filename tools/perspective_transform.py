@@ -20,10 +20,10 @@
 # %%
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
 
 # %%
 def print_polyline(img, src):
+    import matplotlib.pyplot as plt
     color_blue = (0, 0, 255)
     img_polylines = np.copy(img)
     src_ints = np.int32(src).reshape((-1,1,2))
@@ -38,6 +38,65 @@ def get_perspective_transform_matrices(img, src, dst):
     return M, Minv
 
 
-def warp_img(img, M_or_Minv):
-    """Warp or unwarp image (depending if M or Minv is passed.)."""
-    return cv2.warpPerspective(img, M_or_Minv, (img.shape[1], img.shape[0]), flags=cv2.INTER_LINEAR)
+def warp_img(img, M_or_Minv, out=None, dsize=None):
+    """Warp or unwarp image (depending if M or Minv is passed.). 
+    Output size dsize=(width, height) defaults to the size of img."""
+    if dsize is None:
+        dsize = (img.shape[1], img.shape[0])
+    return cv2.warpPerspective(img, M_or_Minv, dsize, dst=out, flags=cv2.INTER_LINEAR)
+
+
+def get_scaling_matrix(scale):
+    """Perspective matrix which scales coordinates by scale."""
+    return np.diag([scale, scale, 1.])
+
+
+
+def get_undistort_and_warp_coords(mtx, dist, M, img_size):
+    """Position in the original (distorted) image of each pixel of the undistorted 
+    and warped (using M) image of img_size=(width, height) (size of the warped image)."""
+    width, height = img_size
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    pts_warped = np.dstack((xs, ys)).reshape(-1, 1, 2)
+    # Position of each warped pixel in the undistorted image
+    pts_undist = cv2.perspectiveTransform(pts_warped, np.linalg.inv(M)).reshape(-1, 2)
+    # Position in the distorted (original) image
+    fx, fy, cx, cy = mtx[0, 0], mtx[1, 1], mtx[0, 2], mtx[1, 2]
+    pts_norm = np.ones((pts_undist.shape[0], 3), np.float64)
+    pts_norm[:, 0] = (pts_undist[:, 0] - cx) / fx
+    pts_norm[:, 1] = (pts_undist[:, 1] - cy) / fy
+    pts_dist, _ = cv2.projectPoints(pts_norm, np.zeros(3), np.zeros(3), mtx, dist)
+    map_x = pts_dist[:, 0, 0].reshape(height, width).astype(np.float32)
+    map_y = pts_dist[:, 0, 1].reshape(height, width).astype(np.float32)
+    return map_x, map_y
+
+
+def get_undistort_and_warp_maps(mtx, dist, M, img_size):
+    """Precompute remap tables (fixed-point) which undistort and warp (using M) 
+    an image in one step. img_size=(width, height) is the size of the warped image."""
+    map_x, map_y = get_undistort_and_warp_coords(mtx, dist, M, img_size)
+    return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+
+def crop_maps_to_roi(maps, img_size):
+    """Restrict fixed-point remap tables to the region of interest (ROI) they read from.
+    img_size=(width, height) is the size of the image the maps read from.
+    
+    Returns the ROI (x0, y0, x1, y1) and maps relative to it, i.e. remapping 
+    img[y0:y1, x0:x1] with the new maps gives the same result as remapping img with maps."""
+    width, height = img_size
+    map1, map2 = maps
+    # Bilinear interpolation reads pixels (x, y) to (x+1, y+1)
+    xs, ys = map1[:, :, 0], map1[:, :, 1]
+    inside = (xs >= -1) & (xs < width) & (ys >= -1) & (ys < height)
+    x0 = max(int(xs[inside].min()), 0)
+    y0 = max(int(ys[inside].min()), 0)
+    x1 = min(int(xs[inside].max()) + 2, width)
+    y1 = min(int(ys[inside].max()) + 2, height)
+    map1_roi = map1 - np.array([x0, y0], dtype=map1.dtype)
+    return (x0, y0, x1, y1), (map1_roi, map2)
+
+
+def remap_img(img, maps, out=None):
+    """Remap image using (fixed-point) remap tables, e.g. from get_undistort_and_warp_maps."""
+    return cv2.remap(img, maps[0], maps[1], cv2.INTER_LINEAR, dst=out)
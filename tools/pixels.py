@@ -0,0 +1,93 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Pixels
+#
+# Nonzero pixels of a binary image, extracted once per frame and shared by the
+# lane search stages. Pixels are stored row by row (row-major order) as int32
+# coordinates, so the pixels of a row band or of a corridor along a curve are
+# found without scanning the image again.
+
+# %%
+import numpy as np
+import cv2
+
+# %%
+class PixelSet():
+    """Nonzero pixels x, y (int32, sorted by row, then column) of a binary image of shape (height, width).
+    The pixels of row y are x[row_starts[y]:row_starts[y+1]]."""
+    __slots__ = ('x', 'y', 'shape', 'row_starts', '_index')
+
+    def __init__(self, x, y, shape):
+        self.x = x
+        self.y = y
+        self.shape = tuple(shape)
+        self.row_starts = np.searchsorted(y, np.arange(self.shape[0] + 1))
+        self._index = None
+
+    @classmethod
+    def from_image(cls, img_binary):
+        """Pixel set of the nonzero pixels of img_binary (one scan of the image)."""
+        pts = cv2.findNonZero(img_binary)
+        if pts is None:
+            x = y = np.empty(0, np.int32)
+        else:
+            pts = pts.reshape(-1, 2)
+            x, y = np.ascontiguousarray(pts[:, 0]), np.ascontiguousarray(pts[:, 1])
+        return cls(x, y, img_binary.shape)
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def index(self):
+        """Flat index y * width + x of the pixels (ascending)."""
+        if self._index is None:
+            self._index = self.y.astype(np.int64) * self.shape[1] + self.x
+        return self._index
+
+    def rows(self, y_low, y_high):
+        """Slice of the pixels in rows y_low <= y < y_high."""
+        y_low, y_high = (min(max(int(y), 0), self.shape[0]) for y in (y_low, y_high))
+        return slice(self.row_starts[y_low], self.row_starts[max(y_low, y_high)])
+
+    def histogram(self, y_low=0, y_high=None):
+        """Number of pixels per column in rows y_low <= y < y_high (all rows by default)."""
+        band = self.rows(y_low, self.shape[0] if y_high is None else y_high)
+        return np.bincount(self.x[band], minlength=self.shape[1])
+
+    def in_corridor(self, fit, margin=100):
+        """Pixels x, y with fit(y) - margin < x < fit(y) + margin, fit = [a, b, c] of x = a*y**2 + b*y + c."""
+        height, width = self.shape
+        ys = np.arange(height)
+        fit = np.asarray(fit, dtype=np.float64)
+        fitx = fit[0]*(ys**2) + fit[1]*ys + fit[2]
+        fitx[np.isnan(fitx)] = -np.inf  # no pixel matches
+        # Integer column interval [first, last] of each row
+        first = np.floor(np.clip(fitx - margin, -1, width)).astype(np.int64) + 1
+        last = np.ceil(np.clip(fitx + margin, 0, width)).astype(np.int64) - 1
+        # Pixels of the intervals are consecutive in the (ascending) flat index
+        row_offsets = ys * width
+        starts = np.searchsorted(self.index, row_offsets + first)
+        ends = np.searchsorted(self.index, row_offsets + np.maximum(last, first - 1), side='right')
+        counts = ends - starts
+        # Concatenated ranges [starts, ends)
+        total = counts.sum()
+        if total == 0:
+            return self.x[:0], self.y[:0]
+        range_starts = np.cumsum(counts) - counts
+        idx = np.arange(total) + np.repeat(starts - range_starts, counts)
+        return self.x[idx], self.y[idx]
@@ -21,11 +21,13 @@ import numpy as np
 import cv2
 
 # %%
-def add_colored_plane(img_gray, left_fitx, right_fitx, ploty):
+def add_colored_plane(img_gray, left_fitx, right_fitx, ploty, out=None):
     """Add colerd plane to grayscale image."""
     # Create an image to draw the lines on
-    warp_zero = np.zeros_like(img_gray).astype(np.uint8)
-    color_warp = np.dstack((warp_zero, warp_zero, warp_zero))
+    if out is None:
+        out = np.empty(img_gray.shape + (3,), np.uint8)
+    color_warp = out
+    color_warp.fill(0)
 
     # Recast the x and y points into usable format for cv2.fillPoly()
     pts_left = np.array([np.transpose(np.vstack([left_fitx, ploty]))])
@@ -38,29 +40,72 @@ def add_colored_plane(img_gray, left_fitx, right_fitx, ploty):
 
 
 # %%
-def add_colored_lanes(img_gray, left_lane_inds, right_lane_inds):
-    """Add red lanes to grayscale image."""
-    # Grab activated pixels
-    nonzero = img_gray.nonzero()
-    nonzeroy = np.array(nonzero[0])
-    nonzerox = np.array(nonzero[1])
+def add_colored_lanes(img_gray, left_pixels, right_pixels, out=None):
+    """Add red lanes (pixels given as (x, y) per lane) to grayscale image. 
+    Optionally write to out (pair of 3-channel images)."""
+    (leftx, lefty), (rightx, righty) = left_pixels, right_pixels
     
     # Create an image to draw on and an image to show the selection window
-    out_img = np.dstack((img_gray, img_gray, img_gray))*255
-    window_img = np.zeros_like(out_img)
+    if out is None:
+        out = (np.empty(img_gray.shape + (3,), np.uint8), np.empty(img_gray.shape + (3,), np.uint8))
+    out_img, window_img = out
+    cv2.cvtColor(img_gray, cv2.COLOR_GRAY2RGB, dst=out_img)
+    np.multiply(out_img, 255, out=out_img)
+    window_img.fill(0)
     # Color in left and right line pixels
-    out_img[nonzeroy[left_lane_inds],  nonzerox[left_lane_inds]] = [255, 0, 0]
-    out_img[nonzeroy[right_lane_inds], nonzerox[right_lane_inds]] = [0, 0, 255]
+    out_img[lefty,  leftx] = [255, 0, 0]
+    out_img[righty, rightx] = [0, 0, 255]
     
-    window_img[nonzeroy[left_lane_inds],  nonzerox[left_lane_inds]] = [255, 0, 0] 
-    window_img[nonzeroy[right_lane_inds], nonzerox[right_lane_inds]] = [255, 0, 0] 
+    window_img[lefty,  leftx] = [255, 0, 0] 
+    window_img[righty, rightx] = [255, 0, 0] 
     return out_img, window_img
 
 
 # %%
-def combine_images(img1, img2, val1=1., val2=.3):
+def _fill_poly_subpixel(img, polygons, color, offset, shift=4):
+    """Fill float polygons (list of (n, 2) arrays) with 1/2**shift pixel precision,
+    coordinates relative to offset (x, y)."""
+    pts = [np.round((poly - offset) * (1 << shift)).astype(np.int32) for poly in polygons]
+    cv2.fillPoly(img, pts, color, lineType=cv2.LINE_8, shift=shift)
+
+
+def add_lane_overlay(img, left_fitx, right_fitx, ploty, Minv, step=8, lane_half_width=10,
+                     plane_color=(0, 76, 0), lane_color=(255, 0, 0), buffer=None):
+    """Add plane between the lanes and the lane lines (x values per row ploty in bird's-eye view)
+    to img, in place. Only the polygon vertices (every step-th row) are transformed with Minv,
+    filling and blending are done in camera space inside the bounding box of the polygons.
+    buffer: optional array of at least img.shape used for the overlay."""
+    rows = np.unique(np.r_[0:len(ploty):step, len(ploty) - 1])
+    y, left_x, right_x = ploty[rows], left_fitx[rows], right_fitx[rows]
+    # Polygons as left border top to bottom, then right border bottom to top
+    borders = [(left_x, right_x),
+               (left_x - lane_half_width, left_x + lane_half_width),
+               (right_x - lane_half_width, right_x + lane_half_width)]
+    pts = np.array([np.column_stack((np.r_[x0, x1[::-1]], np.r_[y, y[::-1]])) for x0, x1 in borders])
+    pts = cv2.perspectiveTransform(pts.reshape(-1, 1, 2), Minv).reshape(pts.shape)
+
+    # Bounding box (inside img)
+    height, width = img.shape[:2]
+    with np.errstate(invalid="ignore"):
+        x0, y0 = np.clip(np.floor(np.nanmin(pts, axis=(0, 1))), 0, (width, height)).astype(int)
+        x1, y1 = np.clip(np.ceil(np.nanmax(pts, axis=(0, 1))) + 1, 0, (width, height)).astype(int)
+    if x1 <= x0 or y1 <= y0:
+        return img
+    if buffer is None:
+        buffer = np.empty(img.shape, np.uint8)
+    overlay = buffer[:y1-y0, :x1-x0]
+    overlay.fill(0)
+    _fill_poly_subpixel(overlay, [pts[0]], plane_color, (x0, y0))
+    _fill_poly_subpixel(overlay, [pts[1], pts[2]], lane_color, (x0, y0))
+    roi = img[y0:y1, x0:x1]
+    cv2.add(roi, overlay, dst=roi)
+    return img
+
+
+# %%
+def combine_images(img1, img2, val1=1., val2=.3, out=None):
     """Combine two images."""
-    return cv2.addWeighted(img1, val1, img2, val2, 0)
+    return cv2.addWeighted(img1, val1, img2, val2, 0, dst=out)
 
 # %%
 def add_text_values(img, left_curverad, right_curverad, dist_to_center, average_curve_diameter=True):
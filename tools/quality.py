@@ -0,0 +1,110 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Quality
+#
+# Quality of the lane fits of a frame (pixel support, residuals, lane width and
+# parallelism) and the policy deciding whether a fit is accepted and when the
+# sliding window search has to run again.
+
+# %%
+import numpy as np
+
+from tools import fitting
+
+# %%
+class FitQuality():
+    """Quality metrics of the fits of one frame. Residuals are the RMS distance [full resolution pixels]
+    of the lane pixels to their fit, lane_width is the distance of the fits at the bottom row relative
+    to the image width, width_variation is (max - min) / mean of the distance over all rows (0 if the
+    lanes are parallel). reason is None if the fits are accepted, else the failed check."""
+    __slots__ = ('left_pixel_count', 'right_pixel_count', 'left_residual', 'right_residual',
+                 'lane_width', 'width_variation', 'reason')
+
+    def __init__(self, left_pixel_count, right_pixel_count, left_residual=np.nan, right_residual=np.nan,
+                 lane_width=np.nan, width_variation=np.nan, reason=None):
+        self.left_pixel_count = left_pixel_count
+        self.right_pixel_count = right_pixel_count
+        self.left_residual = left_residual
+        self.right_residual = right_residual
+        self.lane_width = lane_width
+        self.width_variation = width_variation
+        self.reason = reason
+
+    @property
+    def ok(self):
+        return self.reason is None
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return ("FitQuality(pixels=({}, {}), residuals=({:.1f}, {:.1f}) px, lane_width={:.2f}, "
+                "width_variation={:.2f}, reason={})").format(self.left_pixel_count, self.right_pixel_count,
+            self.left_residual, self.right_residual, self.lane_width, self.width_variation, self.reason)
+
+
+def _residual(fit, pixels):
+    x, y = pixels
+    return float(np.sqrt(np.mean(np.square(x - (fit[0]*(y*y) + fit[1]*y + fit[2])))))
+
+
+def measure_fit_quality(left_fit, right_fit, left_pixels, right_pixels, img_shape, scale=1.):
+    """FitQuality of fits to the lane pixels (x, y) of a bird's-eye image of img_shape (height, width),
+    which is scale times the full resolution."""
+    height, width = img_shape
+    widths = fitting.eval_poly2(np.asarray(right_fit) - left_fit, height)
+    return FitQuality(len(left_pixels[0]), len(right_pixels[0]),
+                      _residual(left_fit, left_pixels) / scale, _residual(right_fit, right_pixels) / scale,
+                      float(widths[-1] / width), float((widths.max() - widths.min()) / abs(widths.mean())))
+
+
+# %%
+class QualityPolicy():
+    """Accept fits with at least min_pixels pixels per lane (in full resolution), residuals up to
+    max_residual pixels, lane_width within (min, max) and width_variation up to max_width_variation.
+    The sliding window search runs again after reinit_after rejected frames in a row,
+    at most every min_reinit_interval frames."""
+    def __init__(self, min_pixels=50, max_residual=25., lane_width=(0.3, 0.9), max_width_variation=0.3,
+                 reinit_after=5, min_reinit_interval=25):
+        self.min_pixels = min_pixels
+        self.max_residual = max_residual
+        self.lane_width = lane_width
+        self.max_width_variation = max_width_variation
+        self.reinit_after = reinit_after
+        self.min_reinit_interval = min_reinit_interval
+
+    def enough_pixels(self, left_pixel_count, right_pixel_count, scale=1.):
+        """True if both lanes have enough pixels to fit (in an image scale times the full resolution)."""
+        return min(left_pixel_count, right_pixel_count) >= max(1, self.min_pixels * scale**2)
+
+    def check(self, quality, scale=1.):
+        """Set quality.reason to the first failed check (None if all pass), returns quality.ok."""
+        if not self.enough_pixels(quality.left_pixel_count, quality.right_pixel_count, scale):
+            quality.reason = "few_pixels"
+        elif not max(quality.left_residual, quality.right_residual) <= self.max_residual:
+            quality.reason = "residual"
+        elif not self.lane_width[0] <= quality.lane_width <= self.lane_width[1]:
+            quality.reason = "lane_width"
+        elif not quality.width_variation <= self.max_width_variation:
+            quality.reason = "not_parallel"
+        else:
+            quality.reason = None
+        return quality.ok
+
+    def reinit_due(self, bad_frames, frames_since_reinit):
+        """True if the sliding window search should run again."""
+        return bad_frames >= self.reinit_after and frames_since_reinit >= self.min_reinit_interval
@@ -0,0 +1,65 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Result
+#
+# Compact per-frame result of the lane detection (numbers only, the annotated
+# image is optional).
+
+# %%
+class LaneResult():
+    """Lane detection result of one frame.
+    Fits are [a, b, c] of x = a*y**2 + b*y + c in full resolution bird's-eye pixels, curvatures
+    in meters, dist_to_center in meters and the pixel counts are the support of each fit.
+    detected is False if the fits were predicted by the tracker (no pixels were searched), quality is 
+    the FitQuality of the detected fits (None if predicted). Rejected fits are not used, the fits are then 
+    the last good ones.
+    img is the annotated frame if it was rendered, else None."""
+    __slots__ = ('frame_nb', 'left_fit', 'right_fit', 'left_curve', 'right_curve', 'dist_to_center',
+                 'left_pixel_count', 'right_pixel_count', 'detected', 'quality', 'img')
+
+    def __init__(self, frame_nb, left_fit, right_fit, left_curve, right_curve, dist_to_center,
+                 left_pixel_count, right_pixel_count, detected=True, quality=None,
+                 img=None):
+        self.frame_nb = frame_nb
+        self.left_fit = left_fit
+        self.right_fit = right_fit
+        self.left_curve = left_curve
+        self.right_curve = right_curve
+        self.dist_to_center = dist_to_center
+        self.left_pixel_count = left_pixel_count
+        self.right_pixel_count = right_pixel_count
+        self.detected = detected
+        self.quality = quality
+        self.img = img
+
+    def as_dict(self, with_img=False):
+        """Values as dict (e.g. for logging as json), without the image by default."""
+        values = {name: getattr(self, name) for name in self.__slots__ if name != 'img'}
+        for name in ('left_fit', 'right_fit'):
+            values[name] = [float(v) for v in values[name]]
+        for name in ('left_curve', 'right_curve', 'dist_to_center'):
+            values[name] = float(values[name])
+        if self.quality is not None:
+            values['quality'] = self.quality.as_dict()
+        if with_img:
+            values['img'] = self.img
+        return values
+
+    def __repr__(self):
+        return ("LaneResult(frame_nb={}, curves=({:.1f}, {:.1f}) m, dist_to_center={:.3f} m, "
+                "pixels=({}, {}), detected={}, rendered={})").format(self.frame_nb, self.left_curve, self.right_curve,
+            self.dist_to_center, self.left_pixel_count, self.right_pixel_count, self.detected, self.img is not None)
@@ -0,0 +1,258 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Shared ring
+#
+# Frames (and results) between processes without pickling them. A `SharedRing`
+# is a fixed number of equally sized slots in `multiprocessing.shared_memory`,
+# seen as NumPy arrays by every process. Only slot numbers go through the
+# queues: the writer takes a slot from the `free` queue, fills it in place and
+# puts (slot, sequence number) into the `filled` queue, the reader gets it from
+# there, uses the array without copying it and gives the slot back with
+# `release`. A slot therefore belongs to one process at a time. The sequence
+# number is also stored next to the slots, so a reader can check that the slot
+# still holds the frame it was announced for.
+#
+# A process which fails calls `fail`: readers then get a RuntimeError instead
+# of the end of the stream, and writers waiting for a free slot stop waiting.
+#
+#     frames = SharedRing(8, (720, 1280, 3))
+#     results = SharedRing(8, (), RESULT_DTYPE)
+#     detector = multiprocessing.Process(target=detect_worker, args=(make_lane_detection, frames, results))
+#
+# Rings are passed to child processes as arguments (they attach to the same
+# memory), the process which created a ring unlinks it with `unlink`.
+
+# %%
+import sys
+import time
+import queue
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+from tools.result import LaneResult
+
+# %%
+_END = -1  # Slot number marking the end of the stream in the filled queue
+_ERROR = -2  # Slot number marking a failure (with the error message instead of the sequence number)
+
+
+def _attach(name, unregister):
+    """Attach to the shared memory name without taking over its cleanup. Before Python 3.13 every
+    SharedMemory is registered with the resource tracker, which unlinks it when the tracker ends.
+    With unregister, the memory is removed from the tracker again (for processes with their own tracker)."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    shm = shared_memory.SharedMemory(name)
+    if unregister:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class SharedRing():
+    """Ring of slots arrays of shape and dtype in shared memory, with queues of free and filled slots.
+    ctx: multiprocessing context for the queues (default context if None).
+    shared_tracker: True if the processes the ring is passed to share the resource tracker of this 
+    process (processes started by ctx do). Set it to False otherwise, these processes then unregister 
+    the memory from their own tracker, which would unlink it when they exit (before Python 3.13)."""
+    def __init__(self, slots, shape, dtype=np.uint8, ctx=None, shared_tracker=True):
+        ctx = ctx or multiprocessing
+        self.shared_tracker = shared_tracker
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.free = ctx.Queue()
+        self.filled = ctx.Queue()
+        slot_bytes = max(1, int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize)
+        self.shm = shared_memory.SharedMemory(create=True, size=8 * (slots + 1) + slot_bytes * slots)
+        self.owner = True
+        self._map()
+        self.failed_flag[...] = 0
+        self.seqs[:] = -1
+        for slot in range(slots):
+            self.free.put(slot)
+        self._next_seq = itertools.count()
+
+    def _map(self):
+        self.failed_flag = np.ndarray((), np.int64, self.shm.buf)
+        self.seqs = np.ndarray((self.slots,), np.int64, self.shm.buf, offset=8)
+        self.buffers = np.ndarray((self.slots,) + self.shape, self.dtype, self.shm.buf, offset=8 * (self.slots + 1))
+
+    @property
+    def failed(self):
+        """True if a process using the ring called fail."""
+        return bool(self.failed_flag)
+
+    def __getstate__(self):
+        return {"name": self.shm.name, "slots": self.slots, "shape": self.shape, "dtype": self.dtype,
+                "free": self.free, "filled": self.filled, "shared_tracker": self.shared_tracker}
+
+    def __setstate__(self, state):
+        self.slots = state["slots"]
+        self.shape = state["shape"]
+        self.dtype = state["dtype"]
+        self.free = state["free"]
+        self.filled = state["filled"]
+        self.shared_tracker = state["shared_tracker"]
+        self.shm = _attach(state["name"], unregister=not self.shared_tracker)
+        self.owner = False
+        self._map()
+        self._next_seq = itertools.count()
+
+    # Writer
+    def acquire(self, timeout=None):
+        """Take a free slot, returns (slot, array to fill in place).
+        Raises queue.Empty if no slot became free within timeout seconds, RuntimeError if the ring failed."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.failed:
+                raise RuntimeError("Ring failed, no slot will become free")
+            wait = 0.1 if deadline is None else min(0.1, max(0., deadline - time.monotonic()))
+            try:
+                slot = self.free.get(timeout=wait)
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+                continue
+            return slot, self.buffers[slot]
+
+    def publish(self, slot, seq=None):
+        """Hand the filled slot to the readers with sequence number seq (counted up if None), returns seq."""
+        if seq is None:
+            seq = next(self._next_seq)
+        self.seqs[slot] = seq
+        self.filled.put((slot, seq))
+        return seq
+
+    def put(self, array, seq=None, timeout=None):
+        """Copy array into a free slot and publish it, returns its sequence number."""
+        slot, buffer = self.acquire(timeout)
+        buffer[...] = array
+        return self.publish(slot, seq)
+
+    def put_end(self, readers=1):
+        """Tell the given number of readers that the stream ended (their get returns None)."""
+        for _ in range(readers):
+            self.filled.put((_END, -1))
+
+    def fail(self, message, readers=1):
+        """Mark the ring as failed: writers stop waiting in acquire and the given number of readers 
+        get a RuntimeError with message (instead of the end of the stream)."""
+        self.failed_flag[...] = 1
+        for _ in range(readers):
+            self.filled.put((_ERROR, message))
+
+    # Reader
+    def get(self, timeout=None):
+        """Next filled slot as (slot, seq, array), None at the end of the stream. The array is a view
+        into the shared memory, valid until release(slot). Raises queue.Empty after timeout seconds
+        and RuntimeError if the writer failed."""
+        slot, seq = self.filled.get(timeout=timeout)
+        if slot == _END:
+            return None
+        if slot == _ERROR:
+            raise RuntimeError(seq)
+        if self.seqs[slot] != seq:
+            raise RuntimeError("Slot {} holds sequence number {} instead of {}".format(slot, self.seqs[slot], seq))
+        return slot, seq, self.buffers[slot]
+
+    def release(self, slot):
+        """Give slot back to the writer."""
+        self.free.put(slot)
+
+    def close(self):
+        """Unmap the shared memory in this process (arrays returned before must not be used anymore)."""
+        self.failed_flag = self.seqs = self.buffers = None
+        self.shm.close()
+
+    def unlink(self):
+        """Free the shared memory (creator only, after all processes are done)."""
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        if self.owner:
+            self.unlink()
+        return False
+
+
+# %% [markdown]
+# ## Results
+#
+# LaneResult without image as fixed size record (`seq` is the sequence number
+# of the frame), for a `SharedRing` of shape `()` and dtype `RESULT_DTYPE`.
+
+# %%
+RESULT_DTYPE = np.dtype([('seq', np.int64), ('frame_nb', np.int64), ('left_fit', np.float64, 3),
+                         ('right_fit', np.float64, 3), ('left_curve', np.float64), ('right_curve', np.float64),
+                         ('dist_to_center', np.float64), ('left_pixel_count', np.int64),
+                         ('right_pixel_count', np.int64), ('detected', np.bool_), ('accepted', np.bool_)])
+
+
+def result_to_record(result, record, seq):
+    """Write LaneResult result of frame seq into record (a RESULT_DTYPE array of shape ())."""
+    record['seq'] = seq
+    record['frame_nb'] = result.frame_nb
+    for name in ('left_fit', 'right_fit', 'left_curve', 'right_curve', 'dist_to_center',
+                 'left_pixel_count', 'right_pixel_count', 'detected'):
+        record[name] = getattr(result, name)
+    record['accepted'] = result.quality is None or result.quality.ok
+
+
+def record_to_result(record):
+    """(seq, LaneResult) of record (the quality is only kept as record['accepted'])."""
+    result = LaneResult(int(record['frame_nb']), record['left_fit'].copy(), record['right_fit'].copy(),
+                        float(record['left_curve']), float(record['right_curve']), float(record['dist_to_center']),
+                        int(record['left_pixel_count']), int(record['right_pixel_count']), bool(record['detected']))
+    return int(record['seq']), result
+
+
+# %%
+def detect_worker(make_lane_detection, frames, results, **detect_kwargs):
+    """Detect lanes in the frames of SharedRing frames until its end and put the results (RESULT_DTYPE)
+    into SharedRing results, ends it when done. Target of a detector process, make_lane_detection
+    creates its LaneDetection (see process_video_parallel). With one worker per frame ring, the
+    tracking follows the frames in order. On errors both rings fail (the reader of results gets
+    a RuntimeError, the writer of frames stops waiting for free slots)."""
+    try:
+        lane_detection = make_lane_detection()
+        while True:
+            item = frames.get()
+            if item is None:
+                break
+            slot, seq, img = item
+            try:
+                result = lane_detection.detect_lanes(img, **detect_kwargs)
+            finally:
+                frames.release(slot)
+            result_slot, record = results.acquire()
+            result_to_record(result, record, seq)
+            results.publish(result_slot, seq)
+    except Exception as e:
+        message = "detect_worker failed: {!r}".format(e)
+        frames.fail(message)
+        results.fail(message)
+        raise
+    else:
+        results.put_end()
+    finally:
+        frames.close()
+        results.close()
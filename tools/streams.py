@@ -0,0 +1,127 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Streams
+#
+# Lane detection for many camera streams in one process. Every stream has its
+# own LaneDetection (fits, tracker, buffers), geometry and color lookup table
+# are shared between streams of the same camera model (see
+# `CameraGeometry.shared`). Frames are processed by a thread pool, the frames
+# of one stream one after another and in order. cv2 and NumPy release the GIL,
+# so streams run in parallel; cv2's own threads are limited so that the pool
+# does not oversubscribe the cores.
+
+# %%
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+import cv2
+
+# %%
+class _Stream():
+    """Lane detection and pending frames (img, kwargs, future) of one stream."""
+    __slots__ = ('lane_detection', 'pending', 'running', 'frames', 'errors')
+
+    def __init__(self, lane_detection):
+        self.lane_detection = lane_detection
+        self.pending = deque()
+        self.running = False
+        self.frames = 0
+        self.errors = 0
+
+
+class StreamEngine():
+    """Runs detect_lanes of many streams on a pool of workers threads.
+    cv2_threads: number of threads of each cv2 call (cv2.setNumThreads, process wide),
+    None leaves it unchanged. With the default of 1 thread, each worker uses one core.
+
+    >>> engine = StreamEngine(workers=8)
+    >>> engine.add_stream("cam1", LaneDetection(mtx, dist, src, dst, render_every=0))
+    >>> future = engine.submit("cam1", img)   # future.result() is a LaneResult
+    """
+    def __init__(self, workers=None, cv2_threads=1):
+        self.workers = workers or os.cpu_count()
+        if cv2_threads is not None:
+            cv2.setNumThreads(cv2_threads)
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="lane_stream")
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def add_stream(self, stream_id, lane_detection):
+        """Add stream stream_id, detected with lane_detection (only used by this stream)."""
+        with self.lock:
+            if stream_id in self.streams:
+                raise ValueError("Stream {} exists already".format(stream_id))
+            self.streams[stream_id] = _Stream(lane_detection)
+
+    def remove_stream(self, stream_id):
+        """Remove stream stream_id (frames already submitted are still processed)."""
+        with self.lock:
+            return self.streams.pop(stream_id).lane_detection
+
+    def submit(self, stream_id, img, **detect_kwargs):
+        """Queue img of stream stream_id for detect_lanes(img, **detect_kwargs).
+        Returns a Future of the LaneResult. Frames of a stream are processed in submission order."""
+        future = Future()
+        with self.lock:
+            stream = self.streams[stream_id]
+            stream.pending.append((img, detect_kwargs, future))
+            if stream.running:
+                return future
+            stream.running = True
+        self.pool.submit(self._run, stream)
+        return future
+
+    def _run(self, stream):
+        """Process the pending frames of stream until there are none (only one _run per stream)."""
+        while True:
+            with self.lock:
+                if not stream.pending:
+                    stream.running = False
+                    return
+                img, detect_kwargs, future = stream.pending.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = stream.lane_detection.detect_lanes(img, **detect_kwargs)
+            except Exception as e:
+                stream.errors += 1
+                future.set_exception(e)
+            else:
+                stream.frames += 1
+                future.set_result(result)
+
+    def process(self, imgs, **detect_kwargs):
+        """Detect lanes in one frame per stream (dict stream_id -> img), returns dict stream_id -> LaneResult."""
+        futures = {stream_id: self.submit(stream_id, img, **detect_kwargs) for stream_id, img in imgs.items()}
+        return {stream_id: future.result() for stream_id, future in futures.items()}
+
+    def stats(self):
+        """Frames processed, failed and pending per stream."""
+        with self.lock:
+            return {stream_id: {"frames": s.frames, "errors": s.errors, "pending": len(s.pending)}
+                    for stream_id, s in self.streams.items()}
+
+    def close(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
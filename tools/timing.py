@@ -0,0 +1,183 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Timing
+#
+# Per-stage latency of the lane detection. Every stage keeps its last `window`
+# durations, from which p50/p95/p99 are computed on request. The statistics
+# can be written periodically to a file, as JSON (`.json`) or in the Prometheus
+# text format (any other extension, e.g. for the node_exporter textfile collector).
+#
+# Without a timer the pipeline uses `NULL_TIMER`, whose stages are shared no-op
+# context managers.
+
+# %%
+import os
+import json
+import time
+import tempfile
+from contextlib import nullcontext
+import numpy as np
+
+# %%
+class _Span():
+    """Context manager adding the time spent inside to a stage."""
+    __slots__ = ('samples', 'start')
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.start = 0.
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.samples.add(time.perf_counter() - self.start)
+        return False
+
+
+class _Samples():
+    """Ring buffer of the last durations of a stage."""
+    __slots__ = ('values', 'count')
+
+    def __init__(self, window):
+        self.values = np.zeros(window)
+        self.count = 0
+
+    def add(self, seconds):
+        self.values[self.count % len(self.values)] = seconds
+        self.count += 1
+
+    def last(self):
+        return self.values[:min(self.count, len(self.values))]
+
+
+class StageTimer():
+    """Rolling latency statistics of the stages of the lane detection (last window samples each).
+    With export_path the statistics are written to this file every export_every frames.
+
+    >>> timer = StageTimer(export_path="/var/lib/node_exporter/lane_detection.prom")
+    >>> ld = LaneDetection(mtx, dist, src, dst, timer=timer)
+    """
+    QUANTILES = (50, 95, 99)
+
+    def __init__(self, window=1000, export_path=None, export_every=100):
+        self.window = window
+        self.export_path = export_path
+        self.export_every = export_every
+        self.samples = {}
+        self.spans = {}
+        self.frames = 0
+
+    def stage(self, name):
+        """Context manager measuring stage name (stages can be nested, but not a stage in itself)."""
+        span = self.spans.get(name)
+        if span is None:
+            span = self.spans[name] = _Span(self.samples.setdefault(name, _Samples(self.window)))
+        return span
+
+    def add(self, name, seconds):
+        """Add a duration measured elsewhere."""
+        self.samples.setdefault(name, _Samples(self.window)).add(seconds)
+
+    def frame(self):
+        """Context manager measuring a whole frame (stage 'frame'), exports periodically."""
+        return _FrameSpan(self)
+
+    def _frame_done(self):
+        self.frames += 1
+        if self.export_path and self.export_every and self.frames % self.export_every == 0:
+            self.export(self.export_path)
+
+    def stats(self):
+        """Dict stage -> count, mean, p50, p95, p99 and max in milliseconds (of the last window samples)."""
+        stats = {}
+        for name, samples in self.samples.items():
+            last = samples.last() * 1e3
+            if len(last) == 0:
+                continue
+            stats[name] = dict(count=samples.count, mean=float(last.mean()), max=float(last.max()),
+                               **{"p{}".format(q): float(v) for q, v in zip(
+                                   self.QUANTILES, np.percentile(last, self.QUANTILES))})
+        return stats
+
+    def to_json(self):
+        return json.dumps({"frames": self.frames, "unit": "ms", "stages": self.stats()}, indent=2)
+
+    def to_text(self, prefix="lane_detection"):
+        """Statistics in the Prometheus text format (seconds)."""
+        lines = ["# TYPE {}_stage_seconds summary".format(prefix)]
+        for name, s in self.stats().items():
+            for q in self.QUANTILES:
+                lines.append('{}_stage_seconds{{stage="{}",quantile="{}"}} {:.6g}'.format(
+                    prefix, name, q / 100., s["p{}".format(q)] / 1e3))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, name, s["count"]))
+        lines.append("{}_frames_total {}".format(prefix, self.frames))
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """Write the statistics to path (JSON if it ends with .json, else text), replaced atomically."""
+        content = self.to_json() if path.endswith(".json") else self.to_text()
+        folder = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp_")
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        # mkstemp creates the file readable by the owner only, collectors may run as another user
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+    def reset(self):
+        self.samples = {}
+        self.spans = {}
+        self.frames = 0
+
+    def __str__(self):
+        lines = ["{:<16}{:>8}{:>9}{:>9}{:>9}{:>9}".format("stage [ms]", "count", "mean", "p50", "p95", "p99")]
+        for name, s in self.stats().items():
+            lines.append("{:<16}{:>8}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.2f}".format(
+                name, s["count"], s["mean"], s["p50"], s["p95"], s["p99"]))
+        return "\n".join(lines)
+
+
+class _FrameSpan(_Span):
+    __slots__ = ('timer',)
+
+    def __init__(self, timer):
+        super().__init__(timer.samples.setdefault('frame', _Samples(timer.window)))
+        self.timer = timer
+
+    def __exit__(self, *exc):
+        super().__exit__(*exc)
+        self.timer._frame_done()
+        return False
+
+
+class _NullTimer():
+    """Timer which measures nothing."""
+    _span = nullcontext()
+
+    def stage(self, name):
+        return self._span
+
+    def frame(self):
+        return self._span
+
+    def add(self, name, seconds):
+        pass
+
+
+NULL_TIMER = _NullTimer()
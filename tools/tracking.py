@@ -0,0 +1,113 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Tracking
+#
+# Kalman filter over both lane fits with a constant velocity model. The six
+# coefficients are tracked as the x positions of both lanes at three rows
+# (top, middle and bottom of the bird's-eye image), which are linear in the
+# coefficients but have the same unit (pixels) and similar variances.
+#
+# Between full detections the tracker predicts the fits, a detection is needed
+# every `detect_every` frames or as soon as the predicted position uncertainty
+# exceeds `max_uncertainty` pixels.
+
+# %%
+import numpy as np
+
+# %%
+class LaneTracker():
+    """Kalman filter for the fits (left, right) of x = a*y**2 + b*y + c in full resolution bird's-eye pixels.
+    State: x of both lanes at three rows (6) and their change per frame (6).
+    process_noise: standard deviations (position, velocity) [pixels per frame] of the motion model,
+    measurement_noise: standard deviation [pixels] of detected positions."""
+    def __init__(self, detect_every=3, max_uncertainty=10., process_noise=(1., 0.5), measurement_noise=5.):
+        self.detect_every = detect_every
+        self.max_uncertainty = max_uncertainty
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        # Constant velocity model, positions are measured
+        identity = np.eye(6)
+        self.F = np.block([[identity, identity], [np.zeros((6, 6)), identity]])
+        self.H = np.hstack((identity, np.zeros((6, 6))))
+        self.Q = np.diag([process_noise[0]**2] * 6 + [process_noise[1]**2] * 6)
+        self.R = identity * measurement_noise**2
+        self.reset()
+
+    def reset(self):
+        self.x = None
+        self.P = None
+        self.img_height = None
+        self.frames_since_detection = 0
+
+    def new(self):
+        """Tracker with the same settings and no state."""
+        return type(self)(self.detect_every, self.max_uncertainty, self.process_noise, self.measurement_noise)
+
+    @property
+    def initialized(self):
+        return self.x is not None
+
+    def _rows(self):
+        """Vandermonde rows [y**2, y, 1] of the three tracked rows."""
+        y = np.array([0., (self.img_height - 1) / 2., self.img_height - 1.])
+        return np.column_stack((y**2, y, np.ones(3)))
+
+    def _to_positions(self, fits):
+        return np.dot(np.asarray(fits), self._rows().T).reshape(6)
+
+    def _to_fits(self, positions):
+        return np.linalg.solve(self._rows(), positions.reshape(2, 3).T).T
+
+    @property
+    def fits(self):
+        """Current (left_fit, right_fit)."""
+        left_fit, right_fit = self._to_fits(self.x[:6])
+        return left_fit, right_fit
+
+    @property
+    def uncertainty(self):
+        """Largest standard deviation [pixels] of the tracked positions."""
+        return float(np.sqrt(np.max(np.diag(self.P)[:6])))
+
+    def needs_detection(self):
+        """True if the next frame should be detected instead of predicted."""
+        return (not self.initialized or self.frames_since_detection >= self.detect_every
+                or self.uncertainty > self.max_uncertainty)
+
+    def predict(self):
+        """Advance by one frame, returns the predicted (left_fit, right_fit)."""
+        self.x = self.F.dot(self.x)
+        self.P = self.F.dot(self.P).dot(self.F.T) + self.Q
+        self.frames_since_detection += 1
+        return self.fits
+
+    def update(self, left_fit, right_fit, img_height):
+        """Correct with detected fits (of an image with img_height rows), returns the filtered fits.
+        Call predict first (except for the first frame)."""
+        if not self.initialized or img_height != self.img_height:
+            self.img_height = img_height
+            self.x = np.concatenate((self._to_positions((left_fit, right_fit)), np.zeros(6)))
+            self.P = np.diag([self.measurement_noise**2] * 6 + [(2 * self.measurement_noise)**2] * 6)
+        else:
+            z = self._to_positions((left_fit, right_fit))
+            residual = z - self.H.dot(self.x)
+            S = self.H.dot(self.P).dot(self.H.T) + self.R
+            K = np.linalg.solve(S, self.H.dot(self.P)).T
+            self.x = self.x + K.dot(residual)
+            self.P = (np.eye(12) - K.dot(self.H)).dot(self.P)
+        self.frames_since_detection = 0
+        return self.fits
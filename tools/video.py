@@ -0,0 +1,259 @@
+# ---
+# jupyter:
+#   jupytext:
+#     formats: ipynb,py:percent
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.2'
+#       jupytext_version: 0.8.6
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# %% [markdown]
+# # Video
+#
+# Streaming lane detection on video files. Decoding, detection and encoding run
+# in separate threads connected by bounded queues. cv2 releases the GIL, so the
+# stages overlap and a frame takes about as long as the slowest stage.
+#
+# Long videos can be split into chunks which are processed in a process pool.
+
+# %%
+import os
+import math
+import time
+import shutil
+import tempfile
+import threading
+from queue import Queue, Full, Empty
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+
+# %%
+_END = None  # Marks the end of the stream in the queues
+
+
+class _Stage(threading.Thread):
+    """Thread which runs fct and keeps the exception (if any) and the time spent in fct."""
+    def __init__(self, fct, name):
+        super().__init__(name=name, daemon=True)
+        self.fct = fct
+        self.busy = 0.
+        self.error = None
+
+    def run(self):
+        try:
+            self.fct(self)
+        except Exception as e:
+            self.error = e
+
+
+def _put(queue, item, stages, stop=None):
+    """Put item into queue, give up if one of the stages failed or stop is set."""
+    while True:
+        if any(stage.error for stage in stages) or (stop is not None and stop.is_set()):
+            return False
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+
+
+# %%
+def process_video(lane_detection, input_path, output_path, queue_size=8, fourcc="mp4v",
+                  verbose=True, **detect_kwargs):
+    """Run lane_detection.detect on every frame of the video input_path and write the
+    results to output_path (frame order is preserved). Returns throughput statistics."""
+    cap = cv2.VideoCapture(input_path)
+    if not cap.isOpened():
+        raise IOError("Could not open video {}".format(input_path))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.
+    frames_in = Queue(maxsize=queue_size)
+    frames_out = Queue(maxsize=queue_size)
+    stages = []
+    stop = threading.Event()
+
+    def decode(stage):
+        try:
+            while True:
+                t = time.perf_counter()
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                stage.busy += time.perf_counter() - t
+                if not _put(frames_in, frame, stages, stop):
+                    break
+        finally:
+            cap.release()
+            _put(frames_in, _END, stages, stop)
+
+    def encode(stage):
+        writer = None
+        try:
+            while True:
+                img = frames_out.get()
+                if img is _END:
+                    break
+                t = time.perf_counter()
+                if writer is None:
+                    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps,
+                                             (img.shape[1], img.shape[0]))
+                writer.write(cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+                stage.busy += time.perf_counter() - t
+        finally:
+            if writer is not None:
+                writer.release()
+
+    decoder = _Stage(decode, "decode")
+    encoder = _Stage(encode, "encode")
+    stages.extend([decoder, encoder])
+    t_start = time.perf_counter()
+    decoder.start()
+    encoder.start()
+
+    # Detection runs in this thread. Results are written to a pool of output images;
+    # with queue_size images in the queue and one in the encoder, queue_size + 2 are enough.
+    nb_frames = 0
+    detect_time = 0.
+    outs = None
+    try:
+        while True:
+            frame = frames_in.get()
+            if frame is _END or encoder.error:
+                break
+            if outs is None:
+                outs = [np.empty_like(frame) for _ in range(queue_size + 2)]
+            t = time.perf_counter()
+            img = lane_detection.detect(frame, out=outs[nb_frames % len(outs)], **detect_kwargs)
+            detect_time += time.perf_counter() - t
+            nb_frames += 1
+            if not _put(frames_out, img, stages):
+                break
+    finally:
+        # Also on errors of the detection: stop the decoder, let the encoder finish the output
+        stop.set()
+        _put(frames_out, _END, stages)
+        while decoder.is_alive():
+            try:
+                frames_in.get_nowait()
+            except Empty:
+                pass
+            decoder.join(timeout=0.1)
+        encoder.join()
+    for stage in stages:
+        if stage.error:
+            raise stage.error
+    seconds = time.perf_counter() - t_start
+
+    stats = {"frames": nb_frames, "seconds": seconds, "fps": nb_frames / seconds if seconds else 0.,
+             "decode_seconds": decoder.busy, "detect_seconds": detect_time, "encode_seconds": encoder.busy}
+    if verbose:
+        print("Processed {} frames in {:.1f} s ({:.1f} fps).".format(nb_frames, seconds, stats["fps"]))
+    return stats
+
+
+# %%
+def _process_chunk(make_lane_detection, input_path, segment_path, start, end, warmup_frames, fourcc):
+    """Detect lanes in frames [start, end) of input_path and write them to segment_path 
+    (with a lossless fourcc, the frames are only compressed once when the segments are joined).
+    Fits, tracker and curvature history are first updated (without rendering) on up to 
+    warmup_frames preceding frames."""
+    lane_detection = make_lane_detection()
+    cap = cv2.VideoCapture(input_path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.
+    first = max(0, start - warmup_frames)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+    writer = None
+    nb_frames = 0
+    try:
+        for frame_idx in range(first, end):
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            if frame_idx < start:
+                # Warm-up: only update fits, tracker and curvature history
+                lane_detection.detect_lanes(frame, render=False)
+                continue
+            img = lane_detection.detect(frame)
+            if writer is None:
+                writer = cv2.VideoWriter(segment_path, cv2.VideoWriter_fourcc(*fourcc), fps,
+                                         (img.shape[1], img.shape[0]))
+                if not writer.isOpened():
+                    raise IOError("Could not open segment {} with fourcc {}".format(segment_path, fourcc))
+            writer.write(cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+            nb_frames += 1
+    finally:
+        cap.release()
+        if writer is not None:
+            writer.release()
+    return nb_frames
+
+
+def process_video_parallel(make_lane_detection, input_path, output_path, processes=None, 
+                           chunk_frames=None, warmup_frames=25, fourcc="mp4v", segment_fourcc="FFV1", 
+                           verbose=True):
+    """Detect lanes in the video input_path using a pool of processes, each working on a chunk 
+    of chunk_frames consecutive frames (default: one chunk per process).
+    
+    make_lane_detection is a picklable callable creating a new LaneDetection, e.g. 
+    functools.partial(LaneDetection, mtx, dist, src, dst). Each chunk warms up the tracker on the 
+    warmup_frames preceding frames, so its results are close to a sequential run. 
+    The processed chunks are written losslessly (segment_fourcc, in .avi files) and joined in order 
+    to output_path, which is the only lossy encoding. Returns throughput statistics."""
+    t_start = time.perf_counter()
+    cap = cv2.VideoCapture(input_path)
+    if not cap.isOpened():
+        raise IOError("Could not open video {}".format(input_path))
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.
+    cap.release()
+    processes = processes or os.cpu_count()
+    if chunk_frames is None:
+        chunk_frames = max(1, math.ceil(total_frames / processes))
+    chunks = [(start, min(start + chunk_frames, total_frames)) for start in range(0, total_frames, chunk_frames)]
+
+    tmp_folder = tempfile.mkdtemp(prefix=".lane_detection_", dir=os.path.dirname(os.path.abspath(output_path)))
+    segment_paths = [os.path.join(tmp_folder, "{:06d}.avi".format(i)) for i in range(len(chunks))]
+    try:
+        with ProcessPoolExecutor(processes) as pool:
+            futures = [pool.submit(_process_chunk, make_lane_detection, input_path, segment_path, 
+                                   start, end, warmup_frames, segment_fourcc)
+                       for (start, end), segment_path in zip(chunks, segment_paths)]
+            chunk_sizes = [future.result() for future in futures]
+        t_processed = time.perf_counter()
+        # Join chunks
+        writer = None
+        nb_frames = 0
+        for segment_path in segment_paths:
+            cap = cv2.VideoCapture(segment_path)
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                if writer is None:
+                    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps,
+                                             (frame.shape[1], frame.shape[0]))
+                writer.write(frame)
+                nb_frames += 1
+            cap.release()
+        if writer is not None:
+            writer.release()
+    finally:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+    seconds = time.perf_counter() - t_start
+
+    stats = {"frames": nb_frames, "seconds": seconds, "fps": nb_frames / seconds if seconds else 0.,
+             "chunks": len(chunks), "chunk_frames": chunk_sizes, "processes": processes,
+             "process_seconds": t_processed - t_start, "join_seconds": seconds - (t_processed - t_start)}
+    if verbose:
+        print("Processed {} frames in {} chunks in {:.1f} s ({:.1f} fps).".format(
+            nb_frames, len(chunks), seconds, stats["fps"]))
+    return stats